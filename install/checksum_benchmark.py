@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+"""
+times manifest checksumming of a synthetic tree with different --jobs values
+
+    checksum_benchmark.py --files 2000 --size 1000000 --jobs 1 2 4 8
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import manifest as mf
+
+def make_tree(directory, files, size, per_dir=100):
+    block = os.urandom(min(size, 1 << 20))
+    for i in range(files):
+        subdir = os.path.join(directory, "dir%04d" % (i // per_dir))
+        if not os.path.isdir(subdir):
+            os.makedirs(subdir)
+        with open(os.path.join(subdir, "file%06d.bin" % i), 'wb') as f:
+            # a distinct prefix so no two files hash the same
+            f.write(b"%08d" % i)
+            written = 8
+            while written < size:
+                chunk = block[:size - written]
+                f.write(chunk)
+                written += len(chunk)
+
+def run_check(directory, manifest, jobs):
+    options = mf.create_default_options()
+    options.jobs = jobs
+    options.no_cache = True
+    start = time.time()
+    modified = mf._check_directory_against_manifest(options, directory, manifest)
+    elapsed = time.time() - start
+    if modified:
+        print("Error: %d files did not match the manifest" % len(modified))
+        sys.exit(1)
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark manifest checksums on a synthetic tree")
+    parser.add_argument("--files", type=int, default=2000, help="number of files in the tree")
+    parser.add_argument("--size", type=int, default=1000000, help="bytes per file")
+    parser.add_argument("--checksum-bytes", type=int, default=1000000, help="bytes checksummed per file")
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4, 8], help="--jobs values to time")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per --jobs value, the best is reported")
+    parser.add_argument("--dir", help="where to build the tree (default: a temporary directory)")
+    options = parser.parse_args()
+
+    directory = options.dir or tempfile.mkdtemp(prefix="checksum-benchmark-")
+    try:
+        print("Building %d files of %d bytes in %s" % (options.files, options.size, directory))
+        make_tree(directory, options.files, options.size)
+
+        manifest = {"checksum_bytes": options.checksum_bytes, "files": {}}
+        for root, _, files in os.walk(directory):
+            for f in files:
+                path = os.path.join(root, f)
+                st = os.stat(path)
+                manifest["files"][os.path.relpath(path, directory)] = {
+                    "checksum": mf._get_checksum(manifest, path), "size": st.st_size, "mode": st.st_mode, "tag": "benchmark"
+                }
+
+        hashed = min(options.size, options.checksum_bytes) * options.files
+        print("%6s %10s %12s %10s %8s" % ("jobs", "seconds", "files/sec", "MB/s", "speedup"))
+        baseline = None
+        for jobs in options.jobs:
+            elapsed = min(run_check(directory, manifest, jobs) for _ in range(options.repeat))
+            baseline = baseline or elapsed
+            print("%6d %10.3f %12.0f %10.1f %7.2fx" % (jobs, elapsed, options.files / elapsed, hashed / elapsed / 1e6, baseline / elapsed))
+    finally:
+        if not options.dir:
+            shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
@@ -10,7 +10,11 @@ import sys
 import urllib.request
 import subprocess
 import shutil
+import stat
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
 from datetime import datetime, timedelta, date
 import requests
@@ -19,6 +23,30 @@ import tempfile
 
 DEFAULT_BASE_URL = "https://oceandata.sci.gsfc.nasa.gov/manifest/tags"
 MANIFEST_BASENAME = "manifest.json"
+DEFAULT_PARALLEL = 4
+PARTIAL_SUFFIX = ".part"
+# next to a .part, which version of the file it holds
+PARTIAL_INFO_SUFFIX = ".json"
+
+# sidecar kept next to a manifest'd tree with the last checksum of every file, see _ChecksumCache
+CHECKSUM_CACHE_BASENAME = ".manifest_checksums.json"
+# files modified this recently are not cached, a later write in the same mtime tick would go unnoticed
+CHECKSUM_CACHE_MIN_AGE = 2.0
+# threads hashing files at once, hashlib releases the GIL while it digests large reads
+DEFAULT_JOBS = min(8, os.cpu_count() or 1)
+
+# chunk index published next to manifest.json, lets download fetch only the changed chunks of a file
+CHUNK_INDEX_BASENAME = "manifest_chunks.json"
+# content defined chunking: a gear hash cuts a chunk where its top CHUNK_MASK_BITS bits are zero,
+# giving chunks of CHUNK_MIN_SIZE plus ~64KiB on average, never longer than CHUNK_MAX_SIZE
+CHUNK_ALGORITHM = "gear32"
+CHUNK_MIN_SIZE = 16 * 1024
+CHUNK_MAX_SIZE = 256 * 1024
+CHUNK_MASK_BITS = 16
+# smaller files are always downloaded whole
+DELTA_MIN_FILE_SIZE = 1024 * 1024
+# longest run of changed chunks fetched with one range request
+DELTA_MAX_RANGE = 8 * 1024 * 1024
 
 
 #  ------------------ DANGER -------------------
@@ -42,7 +70,7 @@ DEFAULT_CHUNK_SIZE = 131072
 # requests session object used to keep connections around
 obpgSession = None
 
-def getSession(verbose=0, ntries=5):
+def getSession(verbose=0, ntries=5, pool_size=None):
     global obpgSession
 
     if not obpgSession:
@@ -59,6 +87,11 @@ def getSession(verbose=0, ntries=5):
         if verbose > 1:
             print("reusing existing OBPG session")
 
+    # keep a connection per download thread instead of the default 10
+    if pool_size:
+        for prefix in ('https://', 'http://'):
+            obpgSession.mount(prefix, HTTPAdapter(max_retries=ntries, pool_connections=pool_size, pool_maxsize=pool_size))
+
     return obpgSession
 
 #  ------------------ DANGER -------------------
@@ -263,6 +296,10 @@ def _add_subparser_download(subparsers):
     parser_download.add_argument("-s", "--save-dir", help="save a copy of the manifest files to this directory")
     parser_download.add_argument("-l", "--local-dir", help="directory containing local manifest files")
     parser_download.add_argument("-w", "--wget", default=False, action="store_true", help="use wget to download")
+    parser_download.add_argument("-p", "--parallel", type=int, default=DEFAULT_PARALLEL, help="number of files to download at once")
+    parser_download.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS, help="number of files to checksum at once")
+    parser_download.add_argument("--delta", default=False, action="store_true", help="update changed files from the chunks that differ when a %s is published" % CHUNK_INDEX_BASENAME)
+    parser_download.add_argument("--no-cache", default=False, action="store_true", help="checksum every file instead of reusing %s" % CHECKSUM_CACHE_BASENAME)
     parser_download.add_argument("-v", "--verbose", action="count", default=0, help="increase output verbosity")
     parser_download.add_argument("files", action="append", nargs="*", default=None, type=str, help="files to download if needed")
     
@@ -278,6 +315,9 @@ def _add_subparser_generate(subparsers):
     parser_gen.add_argument("-e", "--exclude", nargs="+", action='append', help="relative paths to ignore")
     parser_gen.add_argument("-i", "--include", nargs="+", action='append', help="relative paths to include (ignore *)")
     parser_gen.add_argument("-n", "--name", help="bundle name")
+    parser_gen.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS, help="number of files to checksum at once")
+    parser_gen.add_argument("--chunk-index", help="also write the chunk index used for delta downloads (%s) to this file" % CHUNK_INDEX_BASENAME)
+    parser_gen.add_argument("--no-cache", default=False, action="store_true", help="checksum every file instead of reusing %s" % CHECKSUM_CACHE_BASENAME)
     parser_gen.add_argument("directory", help="directory to generate a manifest for")
     parser_gen.set_defaults(func=generate)
 
@@ -300,6 +340,10 @@ def create_default_options():
                 save_dir=None,
                 local_dir=None,
                 wget=False,
+                parallel=DEFAULT_PARALLEL,
+                jobs=DEFAULT_JOBS,
+                no_cache=False,
+                delta=False,
                 files=None,
                 func=list_tags)
     return options
@@ -363,35 +407,69 @@ def get_first_tag(options, args):
         manifest = json.load(manifest)
         print(manifest['tags'][0])
 
-def getFileList(excludeList=None, includeList=None):
+def _compile_prefixes(patternList):
+    """
+    one regex matching any of the path prefixes (first of each option's values), None for no prefixes
+    """
+    if not patternList:
+        return None
+    return re.compile("|".join(re.escape(pattern[0]) for pattern in patternList))
+
+def _scan_directory(excludeList=None, includeList=None):
+    """
+    (relative path, os.DirEntry) of every file under "." that is not excluded, following symlinked
+    directories like os.walk(followlinks=True) and never descending into a directory whose whole
+    subtree is excluded. Paths starting with an exclude prefix are left out unless they also start
+    with an include prefix, an exclude of "." matches every path.
+    """
+    excludeAll = bool(excludeList) and any(exclude[0] == "." for exclude in excludeList)
+    excludeRe = _compile_prefixes(excludeList)
+    includeRe = _compile_prefixes(includeList)
+    includes = [include[0] for include in includeList] if includeList else []
+
+    def excluded(name):
+        if "__pycache__" in name:
+            return True
+        if excludeAll or (excludeRe and excludeRe.match(name)):
+            return not (includeRe and includeRe.match(name))
+        return False
+
+    def prunable(prefix):
+        # every path below starts with prefix, so it is excluded as a whole unless an include
+        # prefix may match somewhere inside it
+        if "__pycache__" in prefix:
+            return True
+        if not (excludeAll or (excludeRe and excludeRe.match(prefix))):
+            return False
+        return not any(include.startswith(prefix) or prefix.startswith(include) for include in includes)
+
     allFiles = []
-    
-    for root, _, files in os.walk(".", followlinks=True):
-        for f in files:
-            if '/' in root:
-                name = root[2:]+'/'+f
-            else:
-                name = f
-    
-            # exclude files if not in include list
-            addIt = True
-            if excludeList:
-                for exclude in excludeList:
-                    if exclude[0] == "." or name.startswith(exclude[0]):
-                        addIt = False
-                        if includeList:
-                            for include in includeList:
-                                if name.startswith(include[0]):
-                                    addIt = True
-                                    break
-                        if not addIt:
-                            break
-            if addIt:
-                if "__pycache__" not in name:
-                    allFiles.append(name)
-    
+    stack = [""]
+    while stack:
+        prefix = stack.pop()
+        try:
+            with os.scandir(prefix or ".") as entries:
+                subdirs = []
+                for entry in entries:
+                    name = prefix + entry.name
+                    try:
+                        isDir = entry.is_dir()
+                    except OSError:
+                        isDir = False
+                    if isDir:
+                        if not prunable(name + "/"):
+                            subdirs.append(name + "/")
+                    elif not excluded(name):
+                        allFiles.append((name, entry))
+        except OSError:
+            continue
+        stack.extend(reversed(subdirs))
+
     return allFiles
 
+def getFileList(excludeList=None, includeList=None):
+    return [name for name, _ in _scan_directory(excludeList, includeList)]
+
 def clean(options, args):
     os.chdir(options.directory)
 
@@ -409,7 +487,7 @@ def clean(options, args):
         manifest = json.load(manifest)
         files = manifest["files"]
         for f in getFileList(options.exclude, options.include):
-            if f == MANIFEST_BASENAME:
+            if f in (MANIFEST_BASENAME, CHECKSUM_CACHE_BASENAME, CHUNK_INDEX_BASENAME):
                 continue
             if not files.get(f):
                 if options.verbose or options.dry_run:
@@ -453,9 +531,14 @@ def generate(options, args):
 
     manifest["tags"] = [options.tag]
 
+    chunk_index = getattr(options, 'chunk_index', None)
+    if chunk_index:
+        chunk_index = os.path.abspath(chunk_index)
+
     os.chdir(options.directory)
 
-    all_files = getFileList(options.exclude, options.include)
+    all_files = _scan_directory(options.exclude, options.include)
+    all_names = set(name for name, _ in all_files)
 
     if options.name:
         manifest['name'] = options.name
@@ -466,33 +549,44 @@ def generate(options, args):
     files_to_delete = []
     if "files" in manifest:
         for path, info in manifest["files"].items():
-            if path not in all_files:
+            if path not in all_names:
                 files_to_delete.append(path)
     for path in files_to_delete:
         del files_entries[path]
 
-    for f in all_files:
-        if os.path.basename(f) == MANIFEST_BASENAME:
+    cache = _ChecksumCache(".", manifest['checksum_bytes'], not getattr(options, 'no_cache', False))
+
+    regular_files = []
+    for f, entry in all_files:
+        if os.path.basename(f) == MANIFEST_BASENAME or f in (CHECKSUM_CACHE_BASENAME, CHUNK_INDEX_BASENAME):
             continue
 
         current_entry = files_entries.get(f)
-        if os.path.islink(f):
+        # the scan already knows the file type, stat() is one cached syscall per file
+        if entry.is_symlink():
             linkValue = os.readlink(f)
             if not current_entry or current_entry.get("symlink") != linkValue:
                 info = {"symlink": linkValue, "tag": options.tag}
                 files_entries[f] = info
         else:
-            fileSize = os.path.getsize(f)
-            checksum = _get_checksum(manifest, f)
-            if not current_entry or current_entry.get('size') != fileSize or current_entry.get('checksum') != checksum:
-                info = {
-                    "checksum": checksum, 
-                    "size": fileSize, 
-                    "mode": os.stat(f).st_mode, 
-                    "tag": options.tag
-                }
-                files_entries[f] = info
+            regular_files.append((f, f, entry.stat()))
+
+    checksums = cache.checksums(manifest, regular_files, getattr(options, 'jobs', 1))
+    for (f, _, fileStat), checksum in zip(regular_files, checksums):
+        current_entry = files_entries.get(f)
+        fileSize = fileStat.st_size
+        if not current_entry or current_entry.get('size') != fileSize or current_entry.get('checksum') != checksum:
+            info = {
+                "checksum": checksum, 
+                "size": fileSize, 
+                "mode": fileStat.st_mode, 
+                "tag": options.tag
+            }
+            files_entries[f] = info
+    cache.save()
     manifest["files"] = files_entries
+    if chunk_index:
+        _write_chunk_index(chunk_index, files_entries)
     print(json.dumps(manifest, indent=4, sort_keys=True))
 
 def download(options, args):
@@ -539,8 +633,8 @@ def download(options, args):
     if not modified_files:
         if options.verbose:
             print("No files require downloading")
-    else:
-        _download_files(options, modified_files)
+    elif _download_files(options, modified_files, manifest.get('checksum_bytes')):
+        return 1
 
     if options.save_dir:
         for path, info in manifest['files'].items():
@@ -605,19 +699,420 @@ def _get_checksum(manifest, path):
         checksum.update(current_file.read(manifest['checksum_bytes']))
     return checksum.hexdigest()
 
+class _ChecksumCache:
+    """
+    checksums of the files under a directory keyed on (size, mtime_ns, inode), kept in
+    CHECKSUM_CACHE_BASENAME so files whose stat did not change are not read again
+    """
+
+    def __init__(self, directory, checksum_bytes, enabled=True):
+        self.path = os.path.join(directory, CHECKSUM_CACHE_BASENAME)
+        self.checksum_bytes = checksum_bytes
+        self.enabled = enabled
+        self.entries = {}
+        self.used = {}
+        self.dirty = False
+        if not enabled or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+        # checksums over a different number of bytes are no use
+        if cache.get('checksum_bytes') == checksum_bytes:
+            self.entries = cache.get('files', {})
+
+    def checksums(self, manifest, files, jobs=1):
+        """
+        checksums of a list of (key, path, fileStat) in the same order, reading the changed files
+        on up to jobs threads
+        """
+        results = [None] * len(files)
+        missing = []
+        for i, (key, path, fileStat) in enumerate(files):
+            entry = self.entries.get(key) if self.enabled else None
+            if entry and entry[:3] == [fileStat.st_size, fileStat.st_mtime_ns, fileStat.st_ino]:
+                self.used[key] = entry
+                results[i] = entry[3]
+            else:
+                missing.append(i)
+
+        paths = [files[i][1] for i in missing]
+        if jobs > 1 and len(paths) > 1:
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                computed = [checksum for checksum in pool.map(lambda path: _get_checksum(manifest, path), paths)]
+        else:
+            computed = [_get_checksum(manifest, path) for path in paths]
+
+        now = time.time()
+        for i, checksum in zip(missing, computed):
+            key, path, fileStat = files[i]
+            results[i] = checksum
+            if self.enabled and now - fileStat.st_mtime > CHECKSUM_CACHE_MIN_AGE:
+                self.used[key] = [fileStat.st_size, fileStat.st_mtime_ns, fileStat.st_ino, checksum]
+            self.dirty = True
+        return results
+
+    def save(self):
+        """
+        writes the entries looked up since loading, dropping files that are gone
+        """
+        if not self.enabled or not (self.dirty or len(self.used) != len(self.entries)):
+            return
+        tmp = self.path + PARTIAL_SUFFIX
+        try:
+            with open(tmp, 'w') as cache_file:
+                json.dump({"checksum_bytes": self.checksum_bytes, "files": self.used}, cache_file)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print("Warning: could not write %s: %s" % (self.path, e), file=sys.stderr)
+
 def _check_directory_against_manifest(options, directory, manifest):
     modified_files = {}
+    cache = _ChecksumCache(directory, manifest['checksum_bytes'], not getattr(options, 'no_cache', False))
+    regular_files = []
     for path, info in manifest['files'].items():
         dest = os.path.join(directory, path)
-        if os.path.islink(dest):
+        try:
+            fileStat = os.lstat(dest)
+        except FileNotFoundError:
+            modified_files[path] = info
+            continue
+        if stat.S_ISLNK(fileStat.st_mode):
             if info.get('symlink') != os.readlink(dest):
                 modified_files[path] = info
-        elif os.path.isfile(dest):
-            if info.get('size') != os.path.getsize(dest) or info.get('checksum') != _get_checksum(manifest, dest) or info.get('mode') != os.stat(dest).st_mode:
+        elif stat.S_ISREG(fileStat.st_mode):
+            if info.get('size') != fileStat.st_size or info.get('mode') != fileStat.st_mode:
                 modified_files[path] = info
+            else:
+                regular_files.append((path, dest, fileStat))
         else:
             modified_files[path] = info
-    return modified_files
+
+    checksums = cache.checksums(manifest, regular_files, getattr(options, 'jobs', 1))
+    for (path, _, _), checksum in zip(regular_files, checksums):
+        if manifest['files'][path].get('checksum') != checksum:
+            modified_files[path] = manifest['files'][path]
+    cache.save()
+    # in manifest order, whichever check caught a file
+    return {path: info for path, info in manifest['files'].items() if path in modified_files}
+
+class _Progress:
+    """
+    aggregate byte and file counts of a parallel download, printed on one line
+    """
+
+    def __init__(self, total_files, total_bytes, verbose=0):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files = 0
+        self.bytes = 0
+        self.start = time.time()
+        self.last_print = 0
+        self.show = verbose or sys.stdout.isatty()
+        self.lock = threading.Lock()
+
+    def add_bytes(self, count):
+        with self.lock:
+            self.bytes += count
+            self._print()
+
+    def add_file(self):
+        with self.lock:
+            self.files += 1
+            self._print()
+
+    def _print(self, force=False):
+        now = time.time()
+        if not self.show or (not force and now - self.last_print < 0.5):
+            return
+        self.last_print = now
+        rate = self.bytes / max(now - self.start, 1e-6) / 1e6
+        percent = 100.0 * self.bytes / self.total_bytes if self.total_bytes else 100.0
+        end = "\n" if force or not sys.stdout.isatty() else ""
+        print("\rDownloaded %d/%d files, %.1f/%.1f MB (%.0f%%) at %.1f MB/s" % (
+            self.files, self.total_files, self.bytes / 1e6, self.total_bytes / 1e6, percent, rate), end=end, flush=True)
+
+    def finish(self):
+        with self.lock:
+            self._print(force=True)
+
+# one random 32 bit value per byte value, derived from sha256 so every install computes the same table
+_GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'big') for i in range(256)]
+_CHUNK_MASK = ((1 << CHUNK_MASK_BITS) - 1) << (32 - CHUNK_MASK_BITS)
+
+def _chunk_length(buf, start, final):
+    """
+    length of the chunk starting at buf[start], None if buf ends before a cut point and more data follows
+    """
+    end = min(len(buf), start + CHUNK_MAX_SIZE)
+    if end - start <= CHUNK_MIN_SIZE:
+        return end - start if final else None
+    # the hash only depends on the last 32 bytes, so start hashing just before the first possible cut
+    gear = _GEAR
+    mask = _CHUNK_MASK
+    h = 0
+    for b in buf[start + CHUNK_MIN_SIZE - 32:start + CHUNK_MIN_SIZE - 1]:
+        h = ((h << 1) + gear[b]) & 0xFFFFFFFF
+    length = CHUNK_MIN_SIZE
+    for b in buf[start + CHUNK_MIN_SIZE - 1:end]:
+        h = ((h << 1) + gear[b]) & 0xFFFFFFFF
+        if not h & mask:
+            return length
+        length += 1
+    if final or end - start == CHUNK_MAX_SIZE:
+        return end - start
+    return None
+
+def _content_chunks(path):
+    """
+    yields (offset, length, sha256) of the content defined chunks of path
+    """
+    offset = 0
+    buf = b""
+    with open(path, 'rb') as f:
+        final = False
+        while not final:
+            data = f.read(4 * CHUNK_MAX_SIZE)
+            final = not data
+            buf += data
+            start = 0
+            while start < len(buf):
+                length = _chunk_length(buf, start, final)
+                if length is None:
+                    break
+                yield offset, length, hashlib.sha256(buf[start:start + length]).hexdigest()
+                offset += length
+                start += length
+            buf = buf[start:]
+
+def _write_chunk_index(path, files_entries):
+    """
+    writes the chunk list of every regular file of at least DELTA_MIN_FILE_SIZE bytes, the current
+    directory being the root of the tree
+    """
+    index = {
+        "chunking": {"algorithm": CHUNK_ALGORITHM, "min_size": CHUNK_MIN_SIZE, "max_size": CHUNK_MAX_SIZE, "mask_bits": CHUNK_MASK_BITS},
+        "files": {},
+    }
+    for f, info in sorted(files_entries.items()):
+        if info.get('checksum') and info['size'] >= DELTA_MIN_FILE_SIZE:
+            index["files"][f] = {
+                "checksum": info['checksum'],
+                "size": info['size'],
+                "chunks": [[length, digest] for _, length, digest in _content_chunks(f)],
+            }
+    tmp = path + PARTIAL_SUFFIX
+    with open(tmp, 'w') as index_file:
+        json.dump(index, index_file, sort_keys=True)
+    os.replace(tmp, path)
+
+def _get_chunk_index(options):
+    """
+    the chunk index published with options.tag, None if there is none or it was chunked differently
+    """
+    if options.local_dir:
+        path = "%s/%s/%s/%s" % (options.local_dir, options.tag, options.name, CHUNK_INDEX_BASENAME)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as index_file:
+            content = index_file.read()
+    else:
+        url = "%s/%s/%s/%s" % (options.base_url, options.tag, options.name, CHUNK_INDEX_BASENAME)
+        try:
+            with closing(getSession(verbose=options.verbose).get(url, timeout=30.)) as req:
+                if req.status_code != 200 or isRequestAuthFailure(req):
+                    return None
+                content = req.content
+        except requests.exceptions.RequestException:
+            return None
+    try:
+        index = json.loads(content)
+    except ValueError:
+        return None
+    expected = {"algorithm": CHUNK_ALGORITHM, "min_size": CHUNK_MIN_SIZE, "max_size": CHUNK_MAX_SIZE, "mask_bits": CHUNK_MASK_BITS}
+    if index.get("chunking") != expected:
+        if options.verbose:
+            print("Ignoring %s, it was not chunked the way this version chunks files" % CHUNK_INDEX_BASENAME)
+        return None
+    if options.save_dir:
+        dest = "%s/%s/%s/%s" % (options.save_dir, options.tag, options.name, CHUNK_INDEX_BASENAME)
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        with open(dest, 'wb') as index_file:
+            index_file.write(content)
+    return index
+
+def _delta_update(info, dest, entry, read_range, checksum_bytes):
+    """
+    rebuilds dest as the file described by its chunk index entry, copying the chunks dest already
+    has and fetching the others with read_range(offset, length)
+    returns the number of bytes fetched
+    """
+    local = {}
+    for offset, length, digest in _content_chunks(dest):
+        local.setdefault(digest, (offset, length))
+
+    # in file order, chunks to copy from dest: ("local", offset, length, None) and runs of
+    # consecutive chunks to fetch in one range request: ("remote", offset, length, [(length, digest), ...])
+    plan = []
+    remote_offset = 0
+    for length, digest in entry['chunks']:
+        if digest in local:
+            plan.append(("local",) + local[digest] + (None,))
+        elif plan and plan[-1][0] == "remote" and plan[-1][2] + length <= DELTA_MAX_RANGE:
+            source, offset, run_length, chunks = plan[-1]
+            plan[-1] = (source, offset, run_length + length, chunks + [(length, digest)])
+        else:
+            plan.append(("remote", remote_offset, length, [(length, digest)]))
+        remote_offset += length
+    if remote_offset != info['size']:
+        raise ValueError("chunk index does not add up to the file size")
+
+    fetched = 0
+    partial = dest + PARTIAL_SUFFIX
+    with open(dest, 'rb') as old, open(partial, 'wb') as new:
+        for source, offset, length, chunks in plan:
+            if source == "local":
+                old.seek(offset)
+                new.write(old.read(length))
+                continue
+            data = read_range(offset, length)
+            if len(data) != length:
+                raise ValueError("short read of bytes %d-%d" % (offset, offset + length - 1))
+            position = 0
+            for chunk_length, digest in chunks:
+                if hashlib.sha256(data[position:position + chunk_length]).hexdigest() != digest:
+                    raise ValueError("chunk at byte %d does not match the chunk index" % (offset + position))
+                position += chunk_length
+            new.write(data)
+            fetched += length
+
+    if os.path.getsize(partial) != info['size'] or (checksum_bytes and _get_checksum({'checksum_bytes': checksum_bytes}, partial) != info['checksum']):
+        os.remove(partial)
+        raise ValueError("rebuilt file does not match the manifest")
+    os.chmod(partial, info['mode'])
+    os.replace(partial, dest)
+    return fetched
+
+def _try_delta_update(options, path, info, dest, index, read_range, checksum_bytes):
+    """
+    _delta_update if the chunk index covers this version of path and an older copy is in place,
+    returns the bytes fetched or None to download the whole file
+    """
+    entry = index['files'].get(path) if index else None
+    if not entry or entry.get('checksum') != info.get('checksum') or entry.get('size') != info.get('size'):
+        return None
+    if os.path.islink(dest) or not os.path.isfile(dest):
+        return None
+    try:
+        fetched = _delta_update(info, dest, entry, read_range, checksum_bytes)
+    except (OSError, ValueError, requests.exceptions.RequestException) as e:
+        if os.path.exists(dest + PARTIAL_SUFFIX):
+            os.remove(dest + PARTIAL_SUFFIX)
+        print("Delta update of %s failed (%s), downloading it whole" % (path, e))
+        return None
+    if options.verbose:
+        print("Updated %s from chunks, fetched %d of %d bytes" % (path, fetched, info['size']))
+    return fetched
+
+def _partial_matches(partial, version):
+    """
+    whether the .part at partial was started for this version (url, size and checksum) of the file
+    """
+    try:
+        with open(partial + PARTIAL_INFO_SUFFIX, 'rb') as info_file:
+            started = json.load(info_file)
+    except (OSError, ValueError):
+        return False
+    return all(started.get(key) == value for key, value in version.items())
+
+def _remove_partial(partial):
+    for path in (partial, partial + PARTIAL_INFO_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+def _download_url(options, url, dest, info=None, progress=None, resume=True):
+    """
+    downloads url to dest through dest.part, resuming a .part left by an earlier attempt with a
+    Range request, then checks the size and checksum from info and renames it into place
+    returns 0 or an error (HTTP status code or message)
+
+    dest.part.json records which version of the file the .part holds and the server's ETag or
+    Last-Modified for it, a .part of any other version is started over and the resumed range is
+    sent with If-Range so a file changed on the server since is fetched whole
+    """
+    session = getSession(verbose=options.verbose)
+    partial = dest + PARTIAL_SUFFIX
+    expected_size = info.get('size') if info else None
+    version = {"url": url, "size": expected_size, "checksum": info.get('checksum') if info else None}
+    if os.path.exists(partial) and not (resume and _partial_matches(partial, version)):
+        _remove_partial(partial)
+
+    status = "no attempts"
+    counted = 0
+    for attempt in range(5):
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        if expected_size is not None and offset > expected_size:
+            _remove_partial(partial)
+            offset = 0
+        headers = {}
+        if offset:
+            headers["Range"] = "bytes=%d-" % offset
+            with open(partial + PARTIAL_INFO_SUFFIX, 'rb') as info_file:
+                validator = json.load(info_file).get('validator')
+            if validator:
+                headers["If-Range"] = validator
+        try:
+            with closing(session.get(url, stream=True, timeout=30., headers=headers)) as req:
+                if req.status_code == 416 and offset == expected_size:
+                    status = 0
+                elif req.status_code not in (200, 206):
+                    return req.status_code
+                elif isRequestAuthFailure(req):
+                    return 401
+                else:
+                    # a 200 means the server ignored the Range header or the file changed, so start over
+                    mode = 'ab' if req.status_code == 206 else 'wb'
+                    if mode == 'wb':
+                        if progress and counted:
+                            progress.add_bytes(-counted)
+                        counted = 0
+                        started = dict(version, validator=req.headers.get('ETag') or req.headers.get('Last-Modified'))
+                        with open(partial + PARTIAL_INFO_SUFFIX, 'w') as info_file:
+                            json.dump(started, info_file)
+                    with open(partial, mode) as fd:
+                        for chunk in req.iter_content(chunk_size=options.chunk_size):
+                            if chunk:
+                                fd.write(chunk)
+                                counted += len(chunk)
+                                if progress:
+                                    progress.add_bytes(len(chunk))
+                    status = 0
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            # keep the .part, the next attempt resumes after what did arrive
+            status = str(e)
+            time.sleep(min(2 ** attempt, 10))
+            continue
+        break
+
+    if status != 0:
+        return status
+
+    if expected_size is not None and os.path.getsize(partial) != expected_size:
+        _remove_partial(partial)
+        return "size mismatch"
+    if info and info.get('checksum') and 'checksum_bytes' in info:
+        if _get_checksum(info, partial) != info['checksum']:
+            _remove_partial(partial)
+            return "checksum mismatch"
+    if info and info.get('mode'):
+        os.chmod(partial, info['mode'])
+    os.replace(partial, dest)
+    _remove_partial(partial)
+    return 0
 
 def _download_file(options, fileName):
     dest = "%s/%s" % (options.dest_dir, fileName)
@@ -641,15 +1136,8 @@ def _download_file(options, fileName):
         command = "cd %s; wget -q %s" % (dest_dir, url)
         run_command(command)
     else:
-        parts = urllib.parse.urlparse(url)
-        #host = "%s://%s" % (parts.scheme, parts.netloc)
-        host = parts.netloc
-        request = parts.path
-        status = httpdl(host, request, localpath=dest_dir, 
-                        outputfilename=os.path.basename(dest),
-                        verbose=options.verbose,
-                        force_download=True,
-                        chunk_size=options.chunk_size)
+        # always fetched whole, the manifest of a tag may have changed since an earlier attempt
+        status = _download_url(options, url, dest, resume=False)
         if status != 0:
             print("Error downloading", dest, ": return code =", status)
             return False
@@ -663,7 +1151,13 @@ def _download_file(options, fileName):
         shutil.copy(src, dest)
     return True
 
-def _download_files(options, file_list):
+def _download_files(options, file_list, checksum_bytes=None):
+    index = None
+    # opt in: the chunker is pure Python (a few MB/s) and holds the GIL, so on a fast link
+    # rebuilding a large file from chunks is slower than downloading it and stalls the other downloads
+    if getattr(options, 'delta', False) and not options.wget:
+        index = _get_chunk_index(options)
+
     if options.local_dir:
         for path, info in file_list.items():
             dest = "%s/%s" % (options.dest_dir, path)
@@ -672,8 +1166,15 @@ def _download_files(options, file_list):
                 os.makedirs(dest_dir)
             if info.get('checksum'):
                 src = "%s/%s/%s/%s" % (options.local_dir, info["tag"], options.name, path)
-                shutil.copy(src, dest)
-                os.chmod(dest, info["mode"])
+
+                def read_range(offset, length):
+                    with open(src, 'rb') as f:
+                        f.seek(offset)
+                        return f.read(length)
+
+                if _try_delta_update(options, path, info, dest, index, read_range, checksum_bytes) is None:
+                    shutil.copy(src, dest)
+                    os.chmod(dest, info["mode"])
             else:
                 src = info['symlink']
                 os.symlink(src, dest)
@@ -697,6 +1198,7 @@ def _download_files(options, file_list):
                 os.chmod(dest, info["mode"])
         return
 
+    downloads = []
     for path, info in file_list.items():
         dest = "%s/%s" % (options.dest_dir, path)
         dest_dir = os.path.dirname(dest)
@@ -704,23 +1206,9 @@ def _download_files(options, file_list):
             os.makedirs(dest_dir)
 
         if info.get('checksum'):
-            if os.path.islink(dest) or os.path.exists(dest):
+            if os.path.islink(dest):
                 os.remove(dest)
-            url = "%s/%s/%s/%s" % (options.base_url, info["tag"], options.name, path)
-            if options.verbose:
-                print("Downloading %s from %s" % (path, url))
-            parts = urllib.parse.urlparse(url)
-            host = parts.netloc
-            request = parts.path
-            status = httpdl(host, request, localpath=dest_dir, 
-                        outputfilename=os.path.basename(dest),
-                        verbose=options.verbose,
-                        force_download=True,
-                        chunk_size=options.chunk_size)
-            if status == 0:
-                os.chmod(dest, info["mode"])
-            else:
-                print("Error downloading", dest, ": return code =", status)
+            downloads.append((path, info, dest))
         else:
             src = info['symlink']
             if options.verbose:
@@ -729,6 +1217,53 @@ def _download_files(options, file_list):
                 os.remove(dest)
             os.symlink(src, dest)
 
+    if not downloads:
+        return
+
+    parallel = max(1, getattr(options, 'parallel', DEFAULT_PARALLEL) or 1)
+    getSession(verbose=options.verbose, pool_size=parallel)
+    progress = _Progress(len(downloads), sum(info.get('size', 0) for _, info, _ in downloads), options.verbose)
+
+    def fetch(download):
+        path, info, dest = download
+        url = "%s/%s/%s/%s" % (options.base_url, info["tag"], options.name, path)
+
+        def read_range(offset, length):
+            headers = {"Range": "bytes=%d-%d" % (offset, offset + length - 1)}
+            with closing(getSession(verbose=options.verbose).get(url, stream=True, timeout=30., headers=headers)) as req:
+                if req.status_code != 206:
+                    raise ValueError("range request returned HTTP %d" % req.status_code)
+                # some servers send everything after offset, only the requested bytes are read
+                data = b""
+                for chunk in req.iter_content(chunk_size=options.chunk_size):
+                    data += chunk
+                    if len(data) >= length:
+                        break
+                return data[:length]
+
+        fetched = _try_delta_update(options, path, info, dest, index, read_range, checksum_bytes)
+        if fetched is not None:
+            # count the whole file as done, the bytes not fetched were reused from the old copy
+            progress.add_bytes(info.get('size', 0))
+            progress.add_file()
+            return path, dest, 0
+        if options.verbose > 1:
+            print("Downloading %s from %s" % (path, url))
+        if checksum_bytes:
+            info = dict(info, checksum_bytes=checksum_bytes)
+        status = _download_url(options, url, dest, info, progress)
+        progress.add_file()
+        return path, dest, status
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        for path, dest, status in pool.map(fetch, downloads):
+            if status != 0:
+                failed += 1
+                print("Error downloading", dest, ": return code =", status)
+    progress.finish()
+    return 1 if failed else None
+
 
 if __name__ == "__main__":
     sys.exit(run())
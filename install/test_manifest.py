@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import manifest as mf
+
+CONTENT = bytes(range(256)) * 4096
+ETAG = '"v1"'
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    """
+    serves server.files, honouring Range and If-Range unless server.ranges is False
+    """
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        start = 0
+        match = self.headers.get("Range", "")
+        if_range = self.headers.get("If-Range")
+        if self.server.ranges and match.startswith("bytes=") and if_range in (None, self.server.etag):
+            start = int(match[len("bytes="):].split("-")[0])
+        if start >= len(body) and start:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % len(body))
+            self.end_headers()
+            return
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(body) - 1, len(body)))
+        self.send_header("Content-Length", str(len(body) - start))
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("ETag", self.server.etag)
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _RangeHandler)
+    httpd.files = {"/file.bin": CONTENT}
+    httpd.etag = ETAG
+    httpd.ranges = True
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+def _url(server):
+    return "http://127.0.0.1:%d/file.bin" % server.server_address[1]
+
+def _info(content=CONTENT):
+    return {
+        "size": len(content),
+        "checksum": hashlib.sha256(content).hexdigest(),
+        "checksum_bytes": len(content),
+        "mode": 0o644,
+    }
+
+def _leave_partial(dest, url, info, data, validator=ETAG):
+    partial = dest + mf.PARTIAL_SUFFIX
+    with open(partial, "wb") as f:
+        f.write(data)
+    version = {"url": url, "size": info["size"], "checksum": info["checksum"], "validator": validator}
+    with open(partial + mf.PARTIAL_INFO_SUFFIX, "w") as f:
+        json.dump(version, f)
+
+def _check_done(dest):
+    with open(dest, "rb") as f:
+        assert f.read() == CONTENT
+    assert not os.path.exists(dest + mf.PARTIAL_SUFFIX)
+    assert not os.path.exists(dest + mf.PARTIAL_SUFFIX + mf.PARTIAL_INFO_SUFFIX)
+
+def test_download_whole(server, tmp_path):
+    dest = str(tmp_path / "file.bin")
+    assert mf._download_url(mf.create_default_options(), _url(server), dest, _info()) == 0
+    _check_done(dest)
+    assert "Range" not in server.requests[0]
+
+def test_resume_partial(server, tmp_path):
+    dest = str(tmp_path / "file.bin")
+    info = _info()
+    _leave_partial(dest, _url(server), info, CONTENT[:300000])
+    assert mf._download_url(mf.create_default_options(), _url(server), dest, info) == 0
+    _check_done(dest)
+    assert server.requests[0]["Range"] == "bytes=300000-"
+    assert server.requests[0]["If-Range"] == ETAG
+
+def test_resume_complete_partial(server, tmp_path):
+    dest = str(tmp_path / "file.bin")
+    info = _info()
+    _leave_partial(dest, _url(server), info, CONTENT)
+    assert mf._download_url(mf.create_default_options(), _url(server), dest, info) == 0
+    _check_done(dest)
+
+def test_partial_of_another_version_is_discarded(server, tmp_path):
+    dest = str(tmp_path / "file.bin")
+    old = _info(CONTENT[::-1])
+    _leave_partial(dest, _url(server), old, CONTENT[::-1][:300000])
+    assert mf._download_url(mf.create_default_options(), _url(server), dest, _info()) == 0
+    _check_done(dest)
+    assert "Range" not in server.requests[0]
+
+def test_partial_without_version_is_discarded(server, tmp_path):
+    dest = str(tmp_path / "file.bin")
+    with open(dest + mf.PARTIAL_SUFFIX, "wb") as f:
+        f.write(b"x" * 300000)
+    assert mf._download_url(mf.create_default_options(), _url(server), dest, _info()) == 0
+    _check_done(dest)
+    assert "Range" not in server.requests[0]
+
+def test_file_changed_on_server_is_fetched_whole(server, tmp_path):
+    dest = str(tmp_path / "file.bin")
+    info = _info()
+    # same manifest entry, but the server's copy changed since the .part was started
+    _leave_partial(dest, _url(server), info, b"x" * 300000, validator='"v0"')
+    assert mf._download_url(mf.create_default_options(), _url(server), dest, info) == 0
+    _check_done(dest)
+    assert server.requests[0]["If-Range"] == '"v0"'
+
+def test_server_without_range_support(server, tmp_path):
+    server.ranges = False
+    dest = str(tmp_path / "file.bin")
+    info = _info()
+    _leave_partial(dest, _url(server), info, CONTENT[:300000])
+    assert mf._download_url(mf.create_default_options(), _url(server), dest, info) == 0
+    _check_done(dest)
+    assert server.requests[0]["Range"] == "bytes=300000-"
+
+def test_checksum_mismatch(server, tmp_path):
+    dest = str(tmp_path / "file.bin")
+    info = _info()
+    server.files["/file.bin"] = CONTENT[:-1] + b"\0"
+    assert mf._download_url(mf.create_default_options(), _url(server), dest, info) == "checksum mismatch"
+    assert not os.path.exists(dest)
+    assert not os.path.exists(dest + mf.PARTIAL_SUFFIX)
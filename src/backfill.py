@@ -0,0 +1,239 @@
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from datetime import datetime
+from job_events import JobLog
+from metrics import CHILD_METRICS_ENV, read_child_records
+from pipeline_steps import (
+    PROCESSING_STEPS, STEP_WORKERS, load_stage_functions, remove_path, run_step, step_metrics,
+    step_output_path, step_summary
+)
+from scheduler import JobScheduler
+from supervisor import ProcessSupervisor
+
+ARCHIVE_EXTENSIONS = ('.tar.gz', '.tar')
+
+# marker written next to a scene's outputs once every step succeeded, later runs skip the scene
+DONE_SUFFIX = ".done.json"
+
+def scene_name(tar_path):
+    name = os.path.basename(tar_path)
+    for ext in ARCHIVE_EXTENSIONS:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+def find_tarballs(inputs):
+    """
+    .tar.gz and .tar files in the given directories or matching the given globs, sorted and unique
+    """
+    paths = set()
+    for item in inputs:
+        matches = [os.path.join(item, name) for name in os.listdir(item)] if os.path.isdir(item) else glob.glob(item)
+        paths.update(os.path.abspath(path) for path in matches if path.endswith(ARCHIVE_EXTENSIONS) and os.path.isfile(path))
+    return sorted(paths)
+
+def link_or_copy(src, dest):
+    """
+    the first step's input is deleted once the step is done, so it gets a link to the tarball
+    """
+    remove_path(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+class Backfill:
+    """
+    runs every scene through PROCESSING_STEPS with a worker pool per step, like the server does for uploads
+    """
+
+    def __init__(self, tarballs, output_dir, stage_workers):
+        self.output_dir = output_dir
+        self.log_dir = os.path.join(output_dir, "logs")
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.supervisor = ProcessSupervisor()
+        self.scenes = {}
+        for tar_path in tarballs:
+            name = scene_name(tar_path)
+            if name in self.scenes:
+                print(f"Warning: skipping {tar_path}, a scene named {name} is already queued")
+                continue
+            self.scenes[name] = {"name": name, "tarball": tar_path, "status": "queued", "steps": []}
+        self._remaining = 0
+        self._cond = threading.Condition()
+        self.scheduler = JobScheduler(stage_workers, self.process_step)
+
+    def base(self, name):
+        return os.path.join(self.output_dir, name)
+
+    def done_path(self, name):
+        return self.base(name) + DONE_SUFFIX
+
+    def run(self):
+        start = time.time()
+        for name, scene in self.scenes.items():
+            if os.path.exists(self.done_path(name)):
+                scene["status"] = "skipped"
+                print(f"[{name}] outputs already exist, skipping")
+                continue
+            with self._cond:
+                self._remaining += 1
+            # the log and the staged tarball are made when the scene's first step starts
+            self.scheduler.submit(name, scene["tarball"])
+
+        try:
+            with self._cond:
+                while self._remaining:
+                    self._cond.wait()
+        except KeyboardInterrupt:
+            print("Interrupted, stopping running steps")
+            for name, scene in self.scenes.items():
+                self.scheduler.cancel(name)
+                self.supervisor.cancel(name)
+                if scene["status"] in ("queued", "running"):
+                    scene["status"] = "interrupted"
+        return time.time() - start
+
+    def finish(self, name, status):
+        scene = self.scenes[name]
+        scene["status"] = status
+        if scene.get("log"):
+            scene["log"].close()
+        with self._cond:
+            self._remaining -= 1
+            self._cond.notify_all()
+
+    def process_step(self, i, name, current_input):
+        """
+        runs PROCESSING_STEPS[i] for a scene and returns its output path, or None if the scene stops here
+        """
+        scene = self.scenes[name]
+        if scene["status"] == "interrupted":
+            return None
+        script, label, input_ext, output_ext = PROCESSING_STEPS[i]
+        scene["status"] = "running"
+        # set when the scene stops at this step, every way out of the step then goes through finish()
+        status = None
+        try:
+            output_path = step_output_path(i, self.base(name))
+            tools_path = f"{self.base(name)}_step{i}_tools.jsonl"
+            if i == 0:
+                scene["log"] = JobLog(maxlen=1, path=os.path.join(self.log_dir, f"{name}.log"))
+            print(f"[{name}] {label} started")
+            scene["log"].append(f"{label} started")
+
+            try:
+                if i == 0:
+                    # staged only now so a large backlog is not copied up front when the output is on another filesystem
+                    current_input = self.base(name) + os.path.basename(scene["tarball"])[len(name):]
+                    link_or_copy(scene["tarball"], current_input)
+                remove_path(output_path)
+                remove_path(tools_path)
+                result = run_step(
+                    self.supervisor, i, name, current_input, output_path, scene["log"].extend,
+                    env={CHILD_METRICS_ENV: tools_path}
+                )
+                step = step_metrics(i, result, read_child_records(tools_path))
+                remove_path(tools_path)
+            except Exception as e:
+                print(f"[{name}] Error at {label}: {e}")
+                status = f"error at {label}"
+                return None
+
+            scene["steps"].append(step)
+            print(f"[{name}] {step_summary(step)}")
+            scene["log"].append(step_summary(step))
+            if result['cancelled']:
+                return None
+            if step["outcome"] != "ok":
+                print(f"[{name}] {step['outcome'].replace('_', ' ')} at {label}, see {scene['log'].path}")
+                status = f"{step['outcome']} at {label}"
+                return None
+
+            # the first step's input is the link to the tarball, never the tarball itself
+            if i < len(PROCESSING_STEPS) - 1:
+                remove_path(current_input)
+                return output_path
+
+            with open(self.done_path(name), "w") as f:
+                json.dump({"tarball": scene["tarball"], "steps": scene["steps"]}, f, indent=2)
+            status = "done"
+            return None
+        except Exception as e:
+            print(f"[{name}] Error after {label}: {e}")
+            status = "failed"
+            return None
+        finally:
+            if status is not None:
+                self.finish(name, status)
+
+    def report(self, wall_time):
+        scenes = []
+        for scene in self.scenes.values():
+            scenes.append({
+                "name": scene["name"],
+                "tarball": scene["tarball"],
+                "status": scene["status"],
+                "wall_time": sum(step["wall_time"] for step in scene["steps"]),
+                "steps": scene["steps"],
+            })
+        counts = {}
+        for scene in scenes:
+            counts[scene["status"]] = counts.get(scene["status"], 0) + 1
+        return {
+            "finished_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "wall_time": wall_time,
+            "counts": counts,
+            "scenes": scenes,
+        }
+
+def print_report(report):
+    labels = [label for _, label, _, _ in PROCESSING_STEPS]
+    print(f"{'scene':<44}{'status':<28}" + "".join(f"{label:>20}" for label in labels))
+    for scene in report["scenes"]:
+        times = {step["step"]: step["wall_time"] for step in scene["steps"]}
+        cells = "".join(f"{times[label]:>19.1f}s" if label in times else f"{'-':>20}" for label in labels)
+        print(f"{scene['name']:<44}{scene['status']:<28}{cells}")
+    counts = ", ".join(f"{count} {status}" for status, count in sorted(report["counts"].items()))
+    print(f"{len(report['scenes'])} scenes in {report['wall_time']:.1f}s: {counts}")
+
+def main():
+    parser = argparse.ArgumentParser(description="run every tarball in a directory or glob through the processing steps")
+    parser.add_argument('inputs', nargs='+', help="directories of .tar.gz/.tar files or globs matching them")
+    parser.add_argument('--output-dir', default='backfill', help="where step outputs, logs and the report go")
+    parser.add_argument('--report', help="summary report path (default: <output-dir>/backfill_report.json)")
+    for script, label, *_ in PROCESSING_STEPS:
+        option = f"--{os.path.splitext(script)[0].replace('_', '-')}-workers"
+        parser.add_argument(option, type=int, default=STEP_WORKERS.get(script, 1), help=f"concurrent '{label}' steps")
+    args = parser.parse_args()
+
+    tarballs = find_tarballs(args.inputs)
+    if not tarballs:
+        print("No .tar.gz or .tar files found")
+        sys.exit(1)
+
+    stage_workers = [getattr(args, os.path.splitext(script)[0] + "_workers") for script, *_ in PROCESSING_STEPS]
+    output_dir = os.path.abspath(args.output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    print(f"Processing {len(tarballs)} tarballs into {output_dir} with {stage_workers} workers per step")
+
+    load_stage_functions()
+    backfill = Backfill(tarballs, output_dir, stage_workers)
+    report = backfill.report(backfill.run())
+
+    report_path = args.report or os.path.join(output_dir, "backfill_report.json")
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print_report(report)
+    print(f"Report written to {report_path}")
+    if any(scene["status"] not in ("done", "skipped") for scene in report["scenes"]):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
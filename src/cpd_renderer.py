@@ -0,0 +1,162 @@
+import os
+import numpy as np
+from netCDF4 import Dataset
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+DEFAULT_LUT_SIZE = 256
+# rows of a band held in memory at once while rendering
+DEFAULT_BLOCK_ROWS = int(os.environ.get('CPD_RENDER_BLOCK_ROWS', 512))
+
+def parse_cpd(cpd_path):
+    """
+    parses a SeaDAS color palette definition (.cpd) file into its points, colors and scaling
+    """
+    entries = {}
+    with open(cpd_path) as cpd:
+        for line in cpd:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            entries[key.strip()] = value.strip()
+
+    num_points = int(entries['numPoints'])
+    colors = np.array(
+        [[int(c) for c in entries[f'color{i}'].split(',')[:3]] for i in range(num_points)],
+        dtype=np.uint8
+    )
+    samples = np.array([float(entries[f'sample{i}']) for i in range(num_points)], dtype=np.float64)
+    return {
+        'num_points': num_points,
+        'colors': colors,
+        'samples': samples,
+        'log_scaled': entries.get('isLogScaled', 'false').lower() == 'true',
+    }
+
+def build_lut(palette, size=DEFAULT_LUT_SIZE):
+    """
+    precomputes a size x 4 RGBA lookup table, the palette points are distributed over the table
+    proportionally to their sample values (in log space for log scaled palettes)
+    """
+    samples = palette['samples']
+    if palette['log_scaled'] and np.all(samples > 0):
+        samples = np.log10(samples)
+    span = samples[-1] - samples[0]
+    if span > 0:
+        positions = (samples - samples[0]) / span
+    else:
+        positions = np.linspace(0.0, 1.0, len(samples))
+
+    t = np.linspace(0.0, 1.0, size)
+    lut = np.empty((size, 4), dtype=np.uint8)
+    for channel in range(3):
+        lut[:, channel] = np.round(np.interp(t, positions, palette['colors'][:, channel]))
+    lut[:, 3] = 255
+    return lut
+
+def apply_lut(data, lut, min, max, log_scaled=False):
+    """
+    maps a band array to RGBA through lut, values are clipped to [min, max] and
+    invalid (masked, NaN, non-positive on a log scale) pixels become transparent
+    """
+    values = np.ma.filled(np.ma.asarray(data, dtype=np.float32), np.nan)
+    if log_scaled:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = np.log10(values)
+        min, max = np.log10(min), np.log10(max)
+
+    valid = np.isfinite(values)
+    scale = (len(lut) - 1) / (max - min) if max > min else 0.0
+    index = np.clip((np.where(valid, values, min) - min) * scale, 0, len(lut) - 1)
+    rgba = lut[np.rint(index).astype(np.intp)]
+    rgba[~valid] = 0
+    return rgba
+
+def find_variable(nc, band):
+    """
+    finds a band in an l2gen product, looking in geophysical_data before the root group
+    """
+    group = nc.groups.get('geophysical_data', nc)
+    if band not in group.variables:
+        group = nc
+    return group.variables[band]
+
+class _TiffWriter:
+    """
+    streams row blocks into an RGBA TIFF, without georeferencing since the l2gen swath has no geotransform
+    """
+
+    def __init__(self, output_path, width, height):
+        driver = gdal.GetDriverByName('GTiff')
+        self.dataset = driver.Create(output_path, width, height, 4, gdal.GDT_Byte, ['COMPRESS=DEFLATE', 'TILED=YES'])
+        self.dataset.GetRasterBand(4).SetColorInterpretation(gdal.GCI_AlphaBand)
+
+    def write(self, row, rgba):
+        for channel in range(4):
+            self.dataset.GetRasterBand(channel + 1).WriteArray(rgba[:, :, channel], 0, row)
+
+    def close(self):
+        self.dataset.FlushCache()
+        self.dataset = None
+
+class _PillowWriter:
+    """
+    collects row blocks into one RGBA array and saves it on close (PNG can not be written by window)
+    """
+
+    def __init__(self, output_path, width, height):
+        self.output_path = output_path
+        self.rgba = np.zeros((height, width, 4), dtype=np.uint8)
+
+    def write(self, row, rgba):
+        self.rgba[row:row + len(rgba)] = rgba
+
+    def close(self):
+        from PIL import Image
+        Image.fromarray(self.rgba, 'RGBA').save(self.output_path)
+        self.rgba = None
+
+def open_writer(output_path, width, height):
+    """
+    picks a PNG or TIFF writer depending on the output extension
+    """
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    if output_path.lower().endswith('.png') or gdal is None:
+        return _PillowWriter(output_path, width, height)
+    return _TiffWriter(output_path, width, height)
+
+def render_band(nc_path, band, targets, block_rows=DEFAULT_BLOCK_ROWS):
+    """
+    colour maps one band into every target, reading the band once in blocks of block_rows rows
+    targets are dicts with cpd_path, min, max, output_path and optionally lut_size
+    """
+    prepared = []
+    for target in targets:
+        palette = parse_cpd(target['cpd_path'])
+        lut = build_lut(palette, target.get('lut_size', DEFAULT_LUT_SIZE))
+        log_scaled = palette['log_scaled'] and target['min'] > 0
+        prepared.append((target, lut, log_scaled))
+
+    with Dataset(nc_path) as nc:
+        variable = find_variable(nc, band)
+        height, width = variable.shape
+        writers = [open_writer(target['output_path'], width, height) for target, _, _ in prepared]
+        try:
+            for row in range(0, height, block_rows):
+                block = variable[row:row + block_rows, :]
+                for writer, (target, lut, log_scaled) in zip(writers, prepared):
+                    writer.write(row, apply_lut(block, lut, target['min'], target['max'], log_scaled))
+        finally:
+            for writer in writers:
+                writer.close()
+
+def render_image(nc_path, band, cpd_path, min, max, output_path, lut_size=DEFAULT_LUT_SIZE):
+    """
+    numpy equivalent of gpt.sh WriteImage: colour maps band between min and max with a .cpd palette
+    """
+    target = {'cpd_path': cpd_path, 'min': min, 'max': max, 'output_path': output_path, 'lut_size': lut_size}
+    render_band(nc_path, band, [target])
@@ -0,0 +1,182 @@
+import json
+import os
+import re
+import threading
+from itertools import islice
+from collections import deque
+
+
+# log levels in increasing severity, a line's level is guessed from its text
+LOG_LEVELS = ("info", "warning", "error")
+LEVEL_PATTERNS = (
+    ("error", re.compile(r"error|fail|traceback|exception|fatal", re.IGNORECASE)),
+    ("warning", re.compile(r"warn", re.IGNORECASE)),
+)
+
+def line_level(line):
+    for level, pattern in LEVEL_PATTERNS:
+        if pattern.search(line):
+            return level
+    return "info"
+
+def filter_records(records, level=None, grep=None):
+    """
+    (seq, line) records at or above level whose line matches the compiled grep pattern
+    """
+    minimum = LOG_LEVELS.index(level) if level else 0
+    return [
+        (seq, line) for seq, line in records
+        if (not minimum or LOG_LEVELS.index(line_level(line)) >= minimum)
+        and (grep is None or grep.search(line))
+    ]
+
+class JobLog:
+    """
+    log of a job where every line gets a monotonically increasing sequence number,
+    so readers can ask for only the lines after the last one they saw
+
+    the newest maxlen lines are kept in memory, with a path every line is also appended to that
+    file (line n holds record n) so older lines are read back from disk instead of being lost,
+    the file is only open while lines are written so idle and finished jobs hold no descriptor
+    """
+
+    def __init__(self, maxlen=2500, path=None):
+        self._records = deque(maxlen=maxlen)
+        self._next_seq = 1
+        self._cond = threading.Condition()
+        self.path = path
+        self._closed = False
+        if path and os.path.exists(path):
+            # continue numbering after the lines of a log written before a restart
+            with open(path, "rb") as f:
+                self._next_seq += sum(1 for _ in f)
+
+    def append(self, line):
+        self.extend([line])
+
+    def extend(self, lines):
+        with self._cond:
+            lines = [line.replace("\n", " ") for line in lines]
+            for line in lines:
+                self._records.append((self._next_seq, line))
+                self._next_seq += 1
+            if self.path and not self._closed and lines:
+                # only "\n" ends a record, progress output keeps its "\r"s
+                with open(self.path, "a", newline="\n") as f:
+                    f.write("".join(line + "\n" for line in lines))
+            self._cond.notify_all()
+
+    @property
+    def last_seq(self):
+        return self._next_seq - 1
+
+    def since(self, seq):
+        """
+        (seq, line) records newer than seq, older lines than those in memory come from the log file
+        """
+        with self._cond:
+            if seq >= self.last_seq:
+                return []
+            first = self._records[0][0] if self._records else self._next_seq
+            skip = max(0, seq - first + 1)
+            records = list(islice(self._records, skip, None))
+        if seq + 1 < first and self.path:
+            records = self._read_file(seq, first) + records
+        return records
+
+    def _read_file(self, seq, end):
+        """
+        records seq + 1 up to end (exclusive) from the log file
+        """
+        with open(self.path, newline="\n") as f:
+            lines = islice(f, seq, end - 1)
+            return [(n, line.rstrip("\n")) for n, line in enumerate(lines, start=seq + 1)]
+
+    def wait(self, seq, timeout):
+        """
+        blocks until there is a record newer than seq or timeout seconds pass
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.last_seq > seq, timeout)
+
+    def close(self):
+        """
+        stops writing to the log file, lines added afterwards are only kept in memory
+        """
+        with self._cond:
+            self._closed = True
+
+    def __iter__(self):
+        return iter([line for _, line in self.since(0)])
+
+    def __len__(self):
+        return len(self._records)
+
+
+class EventBus:
+    """
+    numbered stream of job events (status changes, deletions) that SSE clients resume from by sequence
+    """
+
+    def __init__(self, maxlen=1000):
+        self._events = deque(maxlen=maxlen)
+        self._next_seq = 1
+        self._cond = threading.Condition()
+        # part of every event id, numbering restarts with the process so older ids must not be resumed from
+        self.epoch = os.urandom(4).hex()
+
+    def event_id(self, seq):
+        return f"{self.epoch}-{seq}"
+
+    def cursor(self, event_id):
+        """
+        sequence number to resume after for an event id (or a bare sequence number),
+        0 for ids from another process or that can not be parsed
+        """
+        epoch, _, seq = str(event_id).rpartition("-")
+        if epoch and epoch != self.epoch:
+            return 0
+        try:
+            return int(seq)
+        except ValueError:
+            return 0
+
+    def publish(self, event):
+        with self._cond:
+            self._events.append((self._next_seq, event))
+            self._next_seq += 1
+            self._cond.notify_all()
+
+    @property
+    def last_seq(self):
+        return self._next_seq - 1
+
+    def since(self, seq):
+        """
+        events newer than seq, or None if some of them were already dropped from the buffer
+        or seq is ahead of the bus (a cursor from before a restart)
+        """
+        with self._cond:
+            if seq > self.last_seq:
+                return None
+            if seq == self.last_seq:
+                return []
+            if not self._events or seq + 1 < self._events[0][0]:
+                return None
+            return [(s, event) for s, event in self._events if s > seq]
+
+    def wait(self, seq, timeout):
+        with self._cond:
+            self._cond.wait_for(lambda: self.last_seq > seq, timeout)
+
+
+def sse(data, event=None, id=None):
+    """
+    formats one server-sent event
+    """
+    message = ""
+    if id is not None:
+        message += f"id: {id}\n"
+    if event:
+        message += f"event: {event}\n"
+    return message + f"data: {json.dumps(data)}\n\n"
@@ -0,0 +1,152 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+
+class JobStore:
+    """
+    durable record of every job and the processing steps it has completed, kept in SQLite (WAL mode)
+    so jobs survive a server restart and can resume after their last completed step
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                name TEXT PRIMARY KEY,
+                timestamp TEXT NOT NULL,
+                status TEXT NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 0,
+                next_stage INTEGER NOT NULL DEFAULT 0,
+                current_input TEXT NOT NULL,
+                finished INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS steps (
+                name TEXT NOT NULL,
+                stage INTEGER NOT NULL,
+                output_path TEXT NOT NULL,
+                completed_at TEXT NOT NULL,
+                PRIMARY KEY (name, stage)
+            );
+            CREATE TABLE IF NOT EXISTS memory_usage (
+                name TEXT NOT NULL,
+                stage INTEGER NOT NULL,
+                script TEXT NOT NULL,
+                pixels INTEGER,
+                estimate INTEGER,
+                actual INTEGER NOT NULL,
+                recorded_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS memory_models (
+                script TEXT PRIMARY KEY,
+                bytes_per_pixel REAL NOT NULL,
+                bytes REAL NOT NULL,
+                samples INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS step_metrics (
+                name TEXT NOT NULL,
+                stage INTEGER NOT NULL,
+                recorded_at TEXT NOT NULL,
+                metrics TEXT NOT NULL
+            );
+        """)
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def create(self, name, timestamp, status, priority, next_stage, current_input):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM steps WHERE name = ?", (name,))
+            self._conn.execute("DELETE FROM step_metrics WHERE name = ?", (name,))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (name, timestamp, status, priority, next_stage, current_input, finished)"
+                " VALUES (?, ?, ?, ?, ?, ?, 0)",
+                (name, timestamp, status, priority, next_stage, current_input)
+            )
+            self._conn.execute("COMMIT")
+
+    def set_status(self, name, status, finished=False):
+        self._execute(
+            "UPDATE jobs SET status = ?, finished = ? WHERE name = ?",
+            (status, int(finished), name)
+        )
+
+    def complete_step(self, name, stage, output_path):
+        """
+        records that stage finished with output_path, which becomes the input to resume from
+        """
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                "INSERT OR REPLACE INTO steps (name, stage, output_path, completed_at) VALUES (?, ?, ?, ?)",
+                (name, stage, output_path, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            )
+            self._conn.execute(
+                "UPDATE jobs SET next_stage = ?, current_input = ? WHERE name = ?",
+                (stage + 1, output_path, name)
+            )
+            self._conn.execute("COMMIT")
+
+    def add_metrics(self, name, stage, metrics):
+        """
+        keeps the resource use of one run of a stage, a stage retried after a restart has several
+        """
+        self._execute(
+            "INSERT INTO step_metrics (name, stage, recorded_at, metrics) VALUES (?, ?, ?, ?)",
+            (name, stage, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), json.dumps(metrics))
+        )
+
+    def metrics(self, name):
+        rows = self._execute("SELECT metrics FROM step_metrics WHERE name = ? ORDER BY rowid", (name,))
+        return [json.loads(row['metrics']) for row in rows]
+
+    def record_memory(self, name, stage, script, pixels, estimate, actual):
+        """
+        keeps a step's estimated and measured peak memory, kept after the job is deleted as history
+        """
+        self._execute(
+            "INSERT INTO memory_usage (name, stage, script, pixels, estimate, actual, recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (name, stage, script, pixels, estimate, actual, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        )
+
+    def memory_usage(self, name):
+        return [dict(row) for row in self._execute("SELECT * FROM memory_usage WHERE name = ? ORDER BY rowid", (name,))]
+
+    def scene_pixels(self, name):
+        rows = self._execute(
+            "SELECT pixels FROM memory_usage WHERE name = ? AND pixels IS NOT NULL ORDER BY rowid DESC LIMIT 1", (name,)
+        )
+        return rows[0]['pixels'] if rows else None
+
+    def memory_models(self):
+        return {
+            row['script']: {"bytes_per_pixel": row['bytes_per_pixel'], "bytes": row['bytes'], "samples": row['samples']}
+            for row in self._execute("SELECT * FROM memory_models")
+        }
+
+    def save_memory_model(self, script, model):
+        self._execute(
+            "INSERT OR REPLACE INTO memory_models (script, bytes_per_pixel, bytes, samples) VALUES (?, ?, ?, ?)",
+            (script, model['bytes_per_pixel'], model['bytes'], model['samples'])
+        )
+
+    def steps(self, name):
+        return [dict(row) for row in self._execute("SELECT * FROM steps WHERE name = ? ORDER BY stage", (name,))]
+
+    def delete(self, name):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM steps WHERE name = ?", (name,))
+            self._conn.execute("DELETE FROM step_metrics WHERE name = ?", (name,))
+            self._conn.execute("DELETE FROM jobs WHERE name = ?", (name,))
+            self._conn.execute("COMMIT")
+
+    def jobs(self):
+        return [dict(row) for row in self._execute("SELECT * FROM jobs ORDER BY timestamp")]
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+from tar_extraction import open_input
+
+# content addressed cache of l2gen outputs and mask files, shared by every batch
+# L2GEN_CACHE_DIR: cache location (empty disables the cache)
+# L2GEN_CACHE_MAX_BYTES: disk budget, least recently used entries are evicted past it
+CACHE_DIR = os.environ.get('L2GEN_CACHE_DIR', os.path.expanduser('~/.cache/vibrantseas/l2gen'))
+CACHE_MAX_BYTES = int(os.environ.get('L2GEN_CACHE_MAX_BYTES', 50 * 1024 ** 3))
+
+# par file keys holding per batch paths, their contents are hashed separately instead
+PAR_PATH_KEYS = ('ifile', 'ofile', 'water', 'land')
+
+_l2gen_version = None
+
+def enabled():
+    return bool(CACHE_DIR)
+
+def hash_file(path, checksum=None, chunk_size=1024 * 1024):
+    checksum = checksum or hashlib.sha256()
+    with open_input(path) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            checksum.update(chunk)
+    return checksum
+
+def normalized_par(par_content):
+    """
+    par file contents with batch specific paths replaced, so the same settings hash the same
+    """
+    lines = []
+    for line in par_content.splitlines():
+        key = line.split('=', 1)[0].strip()
+        if key in PAR_PATH_KEYS:
+            line = f"{key}=<{key}>"
+        lines.append(line)
+    return '\n'.join(lines)
+
+def l2gen_version():
+    """
+    l2gen's version string, so a new OCSSW install does not reuse old outputs
+    """
+    global _l2gen_version
+    if _l2gen_version is None:
+        try:
+            result = subprocess.run(['l2gen', '-version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            _l2gen_version = result.stdout.strip() or 'unknown'
+        except OSError:
+            _l2gen_version = 'unknown'
+    return _l2gen_version
+
+def mask_key(tif_path, storage):
+    """
+    cache key of the mask NetCDF made from tif_path with the given storage layout
+    """
+    checksum = hashlib.sha256(b'mask\n')
+    checksum.update(json.dumps(storage, sort_keys=True).encode())
+    return 'mask-' + hash_file(tif_path, checksum).hexdigest()
+
+def l2gen_key(mtl_path, tif_path, par_content):
+    """
+    cache key of the l2gen output for a scene, water mask, par settings and l2gen version
+    """
+    checksum = hashlib.sha256(b'l2gen\n')
+    checksum.update(l2gen_version().encode() + b'\n')
+    checksum.update(normalized_par(par_content).encode() + b'\n')
+    hash_file(mtl_path, checksum)
+    hash_file(tif_path, checksum)
+    return 'l2gen-' + checksum.hexdigest()
+
+def _link(src, dest):
+    """
+    hard links src to dest, copying when they are on different filesystems
+    """
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+def fetch(key, dest):
+    """
+    puts the cached file for key at dest, returns False on a miss
+    """
+    if not enabled():
+        return False
+    entry = os.path.join(CACHE_DIR, key)
+    cached = os.path.join(entry, 'data')
+    if not os.path.isfile(cached):
+        return False
+    _link(cached, dest)
+    # entry mtime doubles as the last use time for eviction
+    os.utime(entry)
+    print(f"l2gen cache hit {key}")
+    return True
+
+def store(key, src):
+    """
+    adds src to the cache under key and evicts old entries past the disk budget
+    """
+    if not enabled():
+        return
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    entry = os.path.join(CACHE_DIR, key)
+    if os.path.isdir(entry):
+        return
+    staging = os.path.join(CACHE_DIR, f".{key}.{os.getpid()}")
+    os.makedirs(staging, exist_ok=True)
+    _link(src, os.path.join(staging, 'data'))
+    try:
+        os.rename(staging, entry)
+    except OSError:
+        # another job stored the same key first
+        shutil.rmtree(staging, ignore_errors=True)
+        return
+    print(f"l2gen cache stored {key}")
+    evict()
+
+def evict(max_bytes=None):
+    """
+    removes least recently used entries until the cache fits in max_bytes
+    """
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        entry = os.path.join(CACHE_DIR, name)
+        data = os.path.join(entry, 'data')
+        if name.startswith('.') or not os.path.isfile(data):
+            continue
+        entries.append((os.stat(entry).st_mtime, os.path.getsize(data), entry))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        print(f"l2gen cache evicting {os.path.basename(entry)}")
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
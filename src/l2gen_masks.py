@@ -0,0 +1,245 @@
+import os
+from datetime import datetime
+import numpy as np
+from netCDF4 import Dataset
+
+try:
+    from osgeo import gdal, osr
+except ImportError:
+    gdal = None
+
+# Band1 value each mask flags, in the order the mask variables are created
+MASK_CLASSES = [
+    ('watermask', 1),
+    ('landmask', 0),
+    ('cloudmask', 2),
+    ('shadowmask', 3),
+]
+
+# rows of Band1 processed at once when building the masks
+MASK_BLOCK_ROWS = int(os.environ.get('MASK_BLOCK_ROWS', 1024))
+
+# storage layout of the mask variables, the defaults keep netCDF's contiguous uncompressed layout
+# MASK_CHUNK_ROWS/MASK_CHUNK_COLS: chunk shape (0 columns = full scanlines, 0 rows = contiguous unless compressed)
+# MASK_ZLIB/MASK_COMPLEVEL/MASK_SHUFFLE: deflate compression of the chunks
+MASK_STORAGE = {
+    'chunk_rows': int(os.environ.get('MASK_CHUNK_ROWS', 0)),
+    'chunk_cols': int(os.environ.get('MASK_CHUNK_COLS', 0)),
+    'zlib': os.environ.get('MASK_ZLIB', '0') == '1',
+    'complevel': int(os.environ.get('MASK_COMPLEVEL', 4)),
+    'shuffle': os.environ.get('MASK_SHUFFLE', '1') == '1',
+}
+
+def needs_netcdf4(storage=None):
+    """
+    True when the mask layout uses chunking or compression, which netCDF-3 files can not store
+    """
+    storage = MASK_STORAGE if storage is None else storage
+    return storage['zlib'] or storage['chunk_rows'] > 0
+
+def mask_storage_options(shape, storage=None):
+    """
+    createVariable keyword arguments for mask variables of shape, empty for the default layout
+    """
+    storage = MASK_STORAGE if storage is None else storage
+    options = {}
+    if not needs_netcdf4(storage):
+        return options
+    if storage['zlib']:
+        options['zlib'] = True
+        options['complevel'] = storage['complevel']
+        options['shuffle'] = storage['shuffle']
+    # compression needs chunks, default to blocks of whole scanlines as l2gen reads them
+    rows = storage['chunk_rows'] or 16
+    cols = storage['chunk_cols'] or shape[1]
+    options['chunksizes'] = (min(rows, shape[0]), min(cols, shape[1]))
+    return options
+
+def fill_mask_block(block, mask_variables, start, out):
+    """
+    writes the masks for one block of Band1 rows starting at row start, out is a reusable boolean buffer
+    """
+    out = out[:len(block)]
+    for variable, (_, value) in zip(mask_variables, MASK_CLASSES):
+        np.equal(block, value, out=out)
+        variable[start:start + len(block), :] = out.view(np.int8)
+
+def aligned_block_rows(mask_variables, block_rows):
+    """
+    rounds block_rows to whole chunks so compressed chunks are not rewritten
+    """
+    chunking = mask_variables[0].chunking()
+    if chunking not in (None, 'contiguous'):
+        block_rows = max(chunking[0], block_rows // chunking[0] * chunking[0])
+    return block_rows
+
+def write_mask_blocks(band1, mask_variables, block_rows=MASK_BLOCK_ROWS):
+    """
+    fills every mask variable from band1 one row block at a time, each block of band1 is read once
+    and compared in place into a reused boolean buffer that is written out as int8 without copies
+    """
+    rows, cols = band1.shape
+    band1.set_auto_mask(False)
+    block_rows = aligned_block_rows(mask_variables, block_rows)
+    buffer = np.empty((min(block_rows, rows), cols), dtype=bool)
+    for start in range(0, rows, block_rows):
+        fill_mask_block(band1[start:start + block_rows, :], mask_variables, start, buffer)
+
+def create_mask_variables(nc, shape, storage=None):
+    """
+    creates the watermask, landmask, cloudmask and shadowmask variables l2gen reads and returns them
+    """
+    # if dimension y not found, create it
+    if 'y' not in nc.dimensions:
+        nc.createDimension('y', shape[0])
+    # if dimension x not found, create it
+    if 'x' not in nc.dimensions:
+        nc.createDimension('x', shape[1])
+
+    options = mask_storage_options(shape, storage)
+
+    watermask = nc.createVariable('watermask', 'b', ('y', 'x'), fill_value=-1, **options)
+    watermask.long_name = "watermask"
+    watermask.description = "A simple binary water mask"
+    watermask.comment = "0 = land, 1 = water"
+    watermask.valid_min = 0
+    watermask.valid_max = 1
+
+    # Create the landmask variable
+    landmask = nc.createVariable('landmask', 'b', ('y', 'x'), fill_value=-1, **options)
+    landmask.long_name = "landmask"
+    landmask.description = "A simple binary land mask"
+    landmask.comment = "0 = water, 1 = land"
+    landmask.valid_min = 0
+    landmask.valid_max = 1
+
+    # Create the cloudmask variable
+    cloudmask = nc.createVariable('cloudmask', 'b', ('y', 'x'), fill_value=-1, **options)
+    cloudmask.long_name = "cloudmask"
+    cloudmask.description = "A simple binary cloud mask"
+    cloudmask.comment = "0 = not clouds, 1 = clouds"
+    cloudmask.valid_min = 0
+    cloudmask.valid_max = 1
+
+    # Create the shadowmask variable
+    shadowmask = nc.createVariable('shadowmask', 'b', ('y', 'x'), fill_value=-1, **options)
+    shadowmask.long_name = "shadowmask"
+    shadowmask.description = "A simple binary shadow mask"
+    shadowmask.comment = "0 = not shadow, 1 = shadow"
+    shadowmask.valid_min = 0
+    shadowmask.valid_max = 1
+
+    return [watermask, landmask, cloudmask, shadowmask]
+
+def has_masks(nc_path):
+    """
+    whether nc_path already holds the mask variables, opened read only since it may be a link into the l2gen cache
+    """
+    try:
+        with Dataset(nc_path, 'r') as nc:
+            return 'watermask' in nc.variables
+    except OSError:
+        return False
+
+def add_masks_to_nc(input_nc, storage=None):
+    """
+    converts watermask.tif Band1 variable array to land, water, and cloud (unused) masks after tif->netcdf conversion which
+    allows the netcdf to be taken as input in the l2gen par file
+    """
+    # Open the NetCDF file in append mode
+    with Dataset(input_nc, 'a') as nc:
+        if 'watermask' in nc.variables:
+            return 0
+        # Band1 is read block by block below rather than all at once
+        print(f"reading {input_nc}")
+        band1 = nc.variables['Band1']
+        mask_variables = create_mask_variables(nc, band1.shape, storage)
+
+        # Fill the masks block by block
+        write_mask_blocks(band1, mask_variables)
+
+def transverse_mercator_attributes(srs):
+    """
+    CF grid mapping attributes gdal_translate writes for a transverse mercator (UTM) projection
+    """
+    return {
+        'grid_mapping_name': "transverse_mercator",
+        'longitude_of_central_meridian': srs.GetProjParm(osr.SRS_PP_CENTRAL_MERIDIAN, 0.0),
+        'false_easting': srs.GetProjParm(osr.SRS_PP_FALSE_EASTING, 0.0),
+        'false_northing': srs.GetProjParm(osr.SRS_PP_FALSE_NORTHING, 0.0),
+        'latitude_of_projection_origin': srs.GetProjParm(osr.SRS_PP_LATITUDE_OF_ORIGIN, 0.0),
+        'scale_factor_at_central_meridian': srs.GetProjParm(osr.SRS_PP_SCALE_FACTOR, 1.0),
+    }
+
+# projections (WKT PROJECTION name) that can be converted in process, others fall back to gdal_translate
+GRID_MAPPINGS = {
+    'Transverse_Mercator': transverse_mercator_attributes,
+}
+
+def tif_to_mask_nc(tif_path, nc_path, storage=None, block_rows=MASK_BLOCK_ROWS):
+    """
+    writes the l2gen mask NetCDF straight from the water mask GeoTIFF in one streaming pass,
+    producing the Band1/x/y/grid mapping layout of gdal_translate -of NetCDF plus the mask variables
+    returns False without writing anything when the GDAL bindings or the projection are not supported
+    """
+    if gdal is None:
+        return False
+    dataset = gdal.Open(tif_path)
+    srs = osr.SpatialReference(wkt=dataset.GetProjection())
+    projection = srs.GetAttrValue('PROJECTION')
+    if projection not in GRID_MAPPINGS:
+        return False
+
+    band = dataset.GetRasterBand(1)
+    rows, cols = dataset.RasterYSize, dataset.RasterXSize
+    x0, dx, _, y0, _, dy = dataset.GetGeoTransform()
+    nodata = band.GetNoDataValue()
+    dtype = band.ReadAsArray(0, 0, 1, 1).dtype
+
+    with Dataset(nc_path, 'w', format='NETCDF4') as nc:
+        nc.Conventions = "CF-1.5"
+        nc.GDAL = f"GDAL {gdal.__version__}"
+        nc.history = f"{datetime.now():%a %b %d %H:%M:%S %Y}: in-process conversion of {tif_path}"
+
+        nc.createDimension('y', rows)
+        nc.createDimension('x', cols)
+
+        mapping_attributes = GRID_MAPPINGS[projection](srs)
+        grid_mapping_name = mapping_attributes['grid_mapping_name']
+        grid_mapping = nc.createVariable(grid_mapping_name, 'c')
+        grid_mapping.setncatts(mapping_attributes)
+        grid_mapping.long_name = "CRS definition"
+        grid_mapping.longitude_of_prime_meridian = 0.0
+        grid_mapping.semi_major_axis = srs.GetSemiMajor()
+        grid_mapping.inverse_flattening = srs.GetInvFlattening()
+        grid_mapping.spatial_ref = srs.ExportToWkt()
+        grid_mapping.crs_wkt = srs.ExportToWkt()
+        grid_mapping.GeoTransform = f"{x0} {dx} 0 {y0} 0 {dy}"
+
+        # like gdal_translate the rows are stored bottom up so y increases with the row index
+        x = nc.createVariable('x', 'f8', ('x',))
+        x.standard_name = "projection_x_coordinate"
+        x.long_name = "x coordinate of projection"
+        x.units = "m"
+        x[:] = x0 + dx * (np.arange(cols) + 0.5)
+        y = nc.createVariable('y', 'f8', ('y',))
+        y.standard_name = "projection_y_coordinate"
+        y.long_name = "y coordinate of projection"
+        y.units = "m"
+        y[:] = y0 + dy * (rows - np.arange(rows) - 0.5)
+
+        band1 = nc.createVariable('Band1', dtype, ('y', 'x'), fill_value=nodata)
+        band1.long_name = "GDAL Band Number 1"
+        band1.grid_mapping = grid_mapping_name
+
+        mask_variables = create_mask_variables(nc, (rows, cols), storage)
+        block_rows = aligned_block_rows(mask_variables, block_rows)
+        buffer = np.empty((min(block_rows, rows), cols), dtype=bool)
+        for start in range(0, rows, block_rows):
+            count = min(block_rows, rows - start)
+            block = band.ReadAsArray(0, rows - start - count, cols, count)[::-1]
+            band1[start:start + count, :] = block
+            fill_mask_block(block, mask_variables, start, buffer)
+
+    dataset = None
+    return True
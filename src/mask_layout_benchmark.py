@@ -0,0 +1,82 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from netCDF4 import Dataset
+from l2gen_masks import MASK_CLASSES, add_masks_to_nc
+
+# (label, storage) pairs compared by default, storage keys match l2gen_masks.MASK_STORAGE
+LAYOUTS = [
+    ("contiguous", {'chunk_rows': 0, 'chunk_cols': 0, 'zlib': False, 'complevel': 0, 'shuffle': False}),
+    ("chunk 16 rows", {'chunk_rows': 16, 'chunk_cols': 0, 'zlib': False, 'complevel': 0, 'shuffle': False}),
+    ("zlib 1, 16 rows", {'chunk_rows': 16, 'chunk_cols': 0, 'zlib': True, 'complevel': 1, 'shuffle': True}),
+    ("zlib 4, 16 rows", {'chunk_rows': 16, 'chunk_cols': 0, 'zlib': True, 'complevel': 4, 'shuffle': True}),
+    ("zlib 4, 128 rows", {'chunk_rows': 128, 'chunk_cols': 0, 'zlib': True, 'complevel': 4, 'shuffle': True}),
+    ("zlib 4, 512x512", {'chunk_rows': 512, 'chunk_cols': 512, 'zlib': True, 'complevel': 4, 'shuffle': True}),
+]
+
+def synthetic_band1(rows, cols, seed=0):
+    """
+    blocky water/land/cloud/shadow classes, roughly as compressible as a real water mask
+    """
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(0, 4, size=(rows // 64 + 1, cols // 64 + 1), dtype=np.uint8)
+    return np.repeat(np.repeat(coarse, 64, axis=0), 64, axis=1)[:rows, :cols]
+
+def write_band1(path, band1, netcdf4):
+    with Dataset(path, 'w', format='NETCDF4' if netcdf4 else 'NETCDF3_64BIT_OFFSET') as nc:
+        nc.createDimension('y', band1.shape[0])
+        nc.createDimension('x', band1.shape[1])
+        nc.createVariable('Band1', 'b', ('y', 'x'))[:] = band1.astype(np.int8)
+
+def read_band1(path):
+    with Dataset(path) as nc:
+        nc.set_auto_mask(False)
+        return nc.variables['Band1'][:]
+
+def scanline_read_time(path, rows_per_read=1):
+    """
+    reads every mask variable scanline by scanline, the way l2gen walks its inputs
+    """
+    start = time.perf_counter()
+    with Dataset(path) as nc:
+        variables = [nc.variables[name] for name, _ in MASK_CLASSES]
+        for row in range(0, variables[0].shape[0], rows_per_read):
+            for variable in variables:
+                variable[row:row + rows_per_read, :]
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="compare WATER_MASK.nc size and read time across mask storage layouts")
+    parser.add_argument('--band1', help="existing WATER_MASK.nc (gdal_translate output) to take Band1 from")
+    parser.add_argument('--rows', type=int, default=7801, help="rows of the synthetic mask (default: Landsat scene)")
+    parser.add_argument('--cols', type=int, default=7681, help="columns of the synthetic mask")
+    parser.add_argument('--dir', help="directory to write the test files in (default: a temporary directory)")
+    args = parser.parse_args()
+
+    band1 = read_band1(args.band1) if args.band1 else synthetic_band1(args.rows, args.cols)
+    work_dir = args.dir or tempfile.mkdtemp(prefix="mask-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+    print(f"Band1 {band1.shape[0]}x{band1.shape[1]}, files in {work_dir}")
+    print(f"{'layout':<20}{'size MB':>10}{'write s':>10}{'read s':>10}")
+
+    try:
+        for label, storage in LAYOUTS:
+            path = os.path.join(work_dir, f"{label.replace(' ', '_').replace(',', '')}.nc")
+            write_band1(path, band1, netcdf4=storage['zlib'] or storage['chunk_rows'] > 0)
+
+            start = time.perf_counter()
+            add_masks_to_nc(path, storage)
+            write_time = time.perf_counter() - start
+
+            size = os.path.getsize(path) / 1e6
+            read_time = scanline_read_time(path)
+            print(f"{label:<20}{size:>10.1f}{write_time:>10.2f}{read_time:>10.2f}")
+    finally:
+        if not args.dir:
+            shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
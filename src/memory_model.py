@@ -0,0 +1,113 @@
+import os
+import tar_extraction
+
+def default_budget():
+    """
+    80% of physical memory in bytes, 0 if it can not be read
+    """
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemTotal:"):
+                    return int(int(line.split()[1]) * 1024 * 0.8)
+    except OSError:
+        pass
+    return 0
+
+# Total memory the running steps may be estimated to use, 0 disables admission control
+MEMORY_BUDGET = int(float(os.environ.get("VIBRANTSEAS_MEMORY_BUDGET_GB", default_budget() / 1024 ** 3)) * 1024 ** 3)
+
+# Estimates are scaled by this to leave room for scenes that use more than the model expects
+MEMORY_HEADROOM = float(os.environ.get("VIBRANTSEAS_MEMORY_HEADROOM", 1.2))
+
+# Weight of the newest measurement in the moving averages
+EWMA_ALPHA = 0.3
+
+# Starting points until a step has been measured, per script: (bytes per scene pixel, bytes)
+# l2gen and the GPT JVM use several GB on a full ~60 megapixel Landsat scene
+DEFAULT_MODELS = {
+    "tar_extraction.py": (0, 256 * 1024 ** 2),
+    "new_l2gen.py": (64, 4 * 1024 ** 3),
+    "seadas_gpt.py": (48, 3 * 1024 ** 3),
+}
+
+def scene_pixels(path):
+    """
+    REFLECTIVE_LINES x REFLECTIVE_SAMPLES from the MTL of an extracted or index staged scene, or None
+    """
+    if not os.path.isdir(path):
+        return None
+    index = tar_extraction.load_index(path)
+    names = index if index is not None else os.listdir(path)
+    mtl_name = next((name for name in names if name.lower().endswith("mtl.txt")), None)
+    if mtl_name is None:
+        return None
+    if index is not None:
+        member = tar_extraction.member_path(path, mtl_name, index)
+    else:
+        member = os.path.join(path, mtl_name)
+    with tar_extraction.open_input(member) as mtl:
+        fields = dict(tar_extraction.MTL_FIELD_PATTERN.findall(mtl.read().decode(errors="replace")))
+    try:
+        return int(fields["REFLECTIVE_LINES"]) * int(fields["REFLECTIVE_SAMPLES"])
+    except (KeyError, ValueError):
+        return None
+
+class MemoryModel:
+    """
+    estimates the peak memory of a step from the scene size and past measurements of that step,
+    keeping a moving average of bytes per pixel (and of bytes, for scenes of unknown size) in the job store
+    """
+
+    def __init__(self, job_store, steps):
+        self.job_store = job_store
+        self.scripts = [script for script, *_ in steps]
+        self.models = {script: {"bytes_per_pixel": bpp, "bytes": size, "samples": 0} for script, (bpp, size) in DEFAULT_MODELS.items()}
+        self.models.update(job_store.memory_models())
+        self._pixels = {}
+        self._estimates = {}
+
+    def pixels(self, batchname, payload):
+        pixels = scene_pixels(payload)
+        if pixels:
+            self._pixels[batchname] = pixels
+        # the MTL is only around until l2gen has run, later steps use the size read then
+        return self._pixels.get(batchname) or self.job_store.scene_pixels(batchname)
+
+    def estimate(self, stage, batchname, payload):
+        """
+        expected peak RSS in bytes of running steps[stage] for batchname on payload
+        """
+        model = self.models.get(self.scripts[stage], {"bytes_per_pixel": 0, "bytes": 0})
+        pixels = self.pixels(batchname, payload)
+        if pixels and model["bytes_per_pixel"]:
+            estimate = model["bytes_per_pixel"] * pixels
+        else:
+            estimate = model["bytes"]
+        estimate = int(estimate * MEMORY_HEADROOM)
+        self._estimates[(stage, batchname)] = estimate
+        return estimate
+
+    def observe(self, stage, batchname, peak_bytes):
+        """
+        records the measured peak next to the estimate and moves the step's averages towards it
+        """
+        script = self.scripts[stage]
+        pixels = self._pixels.get(batchname) or self.job_store.scene_pixels(batchname)
+        estimate = self._estimates.pop((stage, batchname), None)
+        self.job_store.record_memory(batchname, stage, script, pixels, estimate, peak_bytes)
+
+        model = dict(self.models.get(script, {"bytes_per_pixel": 0, "bytes": 0, "samples": 0}))
+        alpha = 1.0 if model["samples"] == 0 else EWMA_ALPHA
+        model["bytes"] += alpha * (peak_bytes - model["bytes"])
+        if pixels:
+            model["bytes_per_pixel"] += alpha * (peak_bytes / pixels - model["bytes_per_pixel"])
+        model["samples"] += 1
+        self.models[script] = model
+        self.job_store.save_memory_model(script, model)
+        return estimate
+
+    def forget(self, batchname):
+        self._pixels.pop(batchname, None)
+        for key in [key for key in self._estimates if key[1] == batchname]:
+            del self._estimates[key]
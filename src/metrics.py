@@ -0,0 +1,137 @@
+import json
+import os
+import subprocess
+import threading
+import time
+from supervisor import exit_code
+
+# JSON lines file the server passes to a step, where the step records the tools it ran (gpt.sh)
+CHILD_METRICS_ENV = "VIBRANTSEAS_CHILD_METRICS"
+
+# ru_inblock / ru_oublock count 512 byte blocks, ru_maxrss is in KiB on Linux
+BLOCK_SIZE = 512
+
+_child_lock = threading.Lock()
+
+def rusage_metrics(rusage):
+    """
+    CPU time, peak RSS and bytes read/written from a wait4 rusage, None fields if it is missing
+    """
+    if rusage is None:
+        return {"user_time": None, "sys_time": None, "max_rss_bytes": None, "read_bytes": None, "write_bytes": None}
+    return {
+        "user_time": rusage.ru_utime,
+        "sys_time": rusage.ru_stime,
+        "max_rss_bytes": rusage.ru_maxrss * 1024,
+        "read_bytes": rusage.ru_inblock * BLOCK_SIZE,
+        "write_bytes": rusage.ru_oublock * BLOCK_SIZE,
+    }
+
+def record_child(record):
+    """
+    appends one tool run to the file named by CHILD_METRICS_ENV, a no-op outside the server
+    """
+    path = os.environ.get(CHILD_METRICS_ENV)
+    if not path:
+        return
+    with _child_lock, open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+def read_child_records(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def run_measured(command, label):
+    """
+    subprocess.run(command, check=True) that records the wall time and resource use of the run
+    """
+    started_at = time.time()
+    start = time.perf_counter()
+    process = subprocess.Popen(command)
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = exit_code(status)
+    record = {
+        "label": label,
+        "command": os.path.basename(command[0]),
+        "returncode": process.returncode,
+        "wall_time": time.perf_counter() - start,
+        # when it ran, so tools that overlapped can be told apart from ones that ran one after another
+        "started_at": started_at,
+        "ended_at": time.time(),
+    }
+    record.update(rusage_metrics(rusage))
+    record_child(record)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+def concurrent_rss_bytes(tools):
+    """
+    largest sum of the peak RSS of tool runs that overlapped in time, an upper bound on what they
+    used together (wait4's ru_maxrss of a step is only the peak of its largest single process)
+    """
+    events = []
+    for tool in tools:
+        if tool.get("max_rss_bytes") is None or tool.get("started_at") is None:
+            continue
+        events.append((tool["started_at"], 1, tool["max_rss_bytes"]))
+        events.append((tool["ended_at"], 0, -tool["max_rss_bytes"]))
+    # at equal times ends sort before starts, so back to back runs do not count as overlapping
+    peak = total = 0
+    for _, _, change in sorted(events):
+        total += change
+        peak = max(peak, total)
+    return peak
+
+# histogram buckets for durations in seconds and sizes in bytes
+SECONDS_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400)
+BYTES_BUCKETS = tuple(2 ** n for n in range(26, 37))
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+class Histogram:
+    """
+    Prometheus style cumulative histogram, one series per combination of label values
+    """
+
+    def __init__(self, name, help, buckets, label_names=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(label_names)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.setdefault(label_values, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        """
+        the histogram in the Prometheus text exposition format, as a list of lines
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    labels = _label_text(self.label_names, label_values, [("le", f"{bound:g}")])
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _label_text(self.label_names, label_values, [("le", "+Inf")])
+                lines.append(f"{self.name}_bucket{labels} {series['count']}")
+                labels = _label_text(self.label_names, label_values)
+                lines.append(f"{self.name}_sum{labels} {series['sum']:g}")
+                lines.append(f"{self.name}_count{labels} {series['count']}")
+        return lines
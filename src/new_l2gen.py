@@ -1,32 +1,13 @@
 import os
+import shutil
 import subprocess
-import numpy as np
-from netCDF4 import Dataset
 import sys
+import l2gen_cache
+import tar_extraction
+from l2gen_masks import MASK_STORAGE, add_masks_to_nc, has_masks, needs_netcdf4, tif_to_mask_nc
 
-if len(sys.argv) < 3:
-    print("Usage: python3 new_l2gen.py <raw_data_path> <nc_output_path>")
-    sys.exit(1)
-
-raw_data_path = sys.argv[1]
-nc_output_path = sys.argv[2]
-
-if not os.path.exists(raw_data_path):
-    print(f"Error: {raw_data_path} does not exist")
-    sys.exit(1)
-
-if os.path.exists(nc_output_path):
-    print(f"Error: {nc_output_path} already exists")
-    sys.exit(1)
-
-params = {
-    "raw_data_path": raw_data_path,
-    "nc_output_path": nc_output_path,
-    "tmp_dir": os.path.join(os.path.dirname(nc_output_path), "tmp")
-}
-
-if not os.path.exists(params["tmp_dir"]):
-    os.makedirs(params["tmp_dir"])
+# settings of the scene being processed, filled in by run()
+params = {}
 
 def gdal_translate(input_file, output_file):
     """
@@ -38,6 +19,9 @@ def gdal_translate(input_file, output_file):
         input_file,
         output_file
     ]
+    # compressed or chunked mask variables need a netCDF-4 file to be appended to
+    if needs_netcdf4():
+        command[3:3] = ['-co', 'FORMAT=NC4']
     subprocess.run(command, check=True)
 
 def l2gen(par_path):
@@ -47,6 +31,21 @@ def l2gen(par_path):
     command = ['l2gen', f'par={par_path}']
     subprocess.run(command, check=True)
 
+def materialize_l2gen_inputs(mtl_name, index):
+    """
+    copies the MTL and the files it names for l2gen out of a staged archive, l2gen can only open real files
+    """
+    mtl_path = tar_extraction.materialize(params['raw_data_path'], mtl_name, index)
+    selector = tar_extraction.MemberSelector()
+    with open(mtl_path) as mtl:
+        selector.read_mtl(mtl.read())
+    mtl_dir = os.path.dirname(mtl_name)
+    for name in selector.required:
+        member = next((m for m in index if m.lower() == os.path.join(mtl_dir, name).lower()), None)
+        if member:
+            tar_extraction.materialize(params['raw_data_path'], member, index)
+    return mtl_path
+
 def watermask_tif_to_nc():
     """
     converts the usgs provided watermask tif file in raw_data_path folder to a netcdf in tmp folder
@@ -54,93 +53,45 @@ def watermask_tif_to_nc():
     print("EHLLO")
     nc_path = os.path.join(params['tmp_dir'], "WATER_MASK.nc")
     print(params['raw_data_path'])
-    for file in os.listdir(params['raw_data_path']):
+    # an archive staged by tar_extraction --index is read in place instead of from extracted files
+    index = tar_extraction.load_index(params['raw_data_path'])
+    for file in (index if index is not None else os.listdir(params['raw_data_path'])):
         print(f"processing {file}")
-        if file.startswith("._"):
-            os.remove(os.path.join(params['raw_data_path'], file))
+        if os.path.basename(file).startswith("._"):
+            if index is None:
+                os.remove(os.path.join(params['raw_data_path'], file))
         elif file.lower().endswith("mtl.txt"):
-            MTL_file_path = os.path.join(params['raw_data_path'], file)
-        elif file.lower().endswith("water_mask.tif") and not os.path.exists(nc_path):
-            gdal_translate(os.path.join(params['raw_data_path'], file), nc_path)
+            if index is None:
+                MTL_file_path = os.path.join(params['raw_data_path'], file)
+            else:
+                MTL_file_path = materialize_l2gen_inputs(file, index)
+        elif file.lower().endswith("water_mask.tif"):
+            if index is None:
+                params['water_mask_tif'] = os.path.join(params['raw_data_path'], file)
+            else:
+                params['water_mask_tif'] = tar_extraction.member_path(params['raw_data_path'], file, index)
+    # a mask left by an interrupted run may be a hard link into the l2gen cache, so it is rebuilt
+    # rather than appended to when it is incomplete
+    if os.path.exists(nc_path) and not has_masks(nc_path):
+        os.remove(nc_path)
+    if not os.path.exists(nc_path):
+        tif_path = params['water_mask_tif']
+        key = l2gen_cache.mask_key(tif_path, MASK_STORAGE) if l2gen_cache.enabled() else None
+        if not (key and l2gen_cache.fetch(key, nc_path)):
+            # write Band1 and the masks in one pass, gdal_translate is the fallback without the GDAL bindings
+            if not tif_to_mask_nc(tif_path, nc_path):
+                gdal_translate(tif_path, nc_path)
+                add_masks_to_nc(nc_path)
+            if key:
+                l2gen_cache.store(key, nc_path)
     return nc_path, MTL_file_path
 
-def add_masks_to_nc(input_nc):
-    """
-    converts watermask.tif Band1 variable array to land, water, and cloud (unused) masks after tif->netcdf conversion which
-    allows the netcdf to be taken as input in the l2gen par file
-    """
-    # Open the NetCDF file in append mode
-    with Dataset(input_nc, 'a') as nc:
-        if 'watermask' in nc.variables:
-            return 0
-        # Read the Band1 variable
-        print(f"reading {input_nc}")
-        print("nc.variables", nc.variables)
-        band1 = nc.variables['Band1'][:]
-        # Check if the new variables already exist, if so delete them
-        if 'watermask' in nc.variables:
-            del nc.variables['watermask']
-        if 'landmask' in nc.variables:
-            del nc.variables['landmask']
-        # Create the watermask variable
-        
-        # if dimension y not found, create it
-        if 'y' not in nc.dimensions:
-            nc.createDimension('y', band1.shape[0])
-        # if dimension x not found, create it
-        if 'x' not in nc.dimensions:
-            nc.createDimension('x', band1.shape[1])
-        
-        watermask = nc.createVariable('watermask', 'b', ('y', 'x'), fill_value=-1)
-        watermask.long_name = "watermask"
-        watermask.description = "A simple binary water mask"
-        watermask.comment = "0 = land, 1 = water"
-        watermask.valid_min = 0
-        watermask.valid_max = 1
-        
-        # Create the landmask variable
-        landmask = nc.createVariable('landmask', 'b', ('y', 'x'), fill_value=-1)
-        landmask.long_name = "landmask"
-        landmask.description = "A simple binary land mask"
-        landmask.comment = "0 = water, 1 = land"
-        landmask.valid_min = 0
-        landmask.valid_max = 1
-        
-        # Create the cloudmask variable
-        cloudmask = nc.createVariable('cloudmask', 'b', ('y', 'x'), fill_value=-1)
-        cloudmask.long_name = "cloudmask"
-        cloudmask.description = "A simple binary cloud mask"
-        cloudmask.comment = "0 = not clouds, 1 = clouds"
-        cloudmask.valid_min = 0
-        cloudmask.valid_max = 1
-        
-        # Create the shadowmask variable
-        shadowmask = nc.createVariable('shadowmask', 'b', ('y', 'x'), fill_value=-1)
-        shadowmask.long_name = "shadowmask"
-        shadowmask.description = "A simple binary shadow mask"
-        shadowmask.comment = "0 = not shadow, 1 = shadow"
-        shadowmask.valid_min = 0
-        shadowmask.valid_max = 1
-        
-        # Fill the watermask and landmask variables
-        watermask_data = np.where(band1 == 1, 1, 0).astype('b')
-        landmask_data = np.where(band1 == 0, 1, 0).astype('b')
-        cloudmask_data = np.where(band1 == 2, 1, 0).astype('b')
-        shadowmask_data = np.where(band1 == 3, 1, 0).astype('b')
-        
-        # Assign the data to the variables
-        watermask[:] = watermask_data
-        landmask[:] = landmask_data
-        cloudmask[:] = cloudmask_data
-        shadowmask[:] = shadowmask_data
-
 def make_masks():
     """
     makes a l2gen usable mask for a particular date given preseadas and seadas paths
     """
-    nc_path, mtl_path = watermask_tif_to_nc()
-    add_masks_to_nc(nc_path)
-    return nc_path, mtl_path
+    # the masks are written (or fetched from the cache) with Band1, so the file is never reopened for writing
+    return watermask_tif_to_nc()
 
 def run_l2gen(data_path):
     """
@@ -179,9 +130,53 @@ land={land}
 
             print(f".par file generated at {par_file_path}")
 
+            # Reuse the output of an earlier run on the same scene, mask and settings
+            key = None
+            if l2gen_cache.enabled():
+                key = l2gen_cache.l2gen_key(mtl_path, params['water_mask_tif'], content)
+                if l2gen_cache.fetch(key, ofile):
+                    return
+
             # Run l2gen with the generated .par file
             l2gen(par_file_path)
 
-print(f"starting l2gen on files at {params['raw_data_path']}, outputting to {params['nc_output_path']}")
+            if key:
+                l2gen_cache.store(key, ofile)
 
-run_l2gen(params['raw_data_path'])
\ No newline at end of file
+def run(raw_data_path, nc_output_path):
+    """
+    stage function: runs l2gen on an extracted (or index staged) scene folder, writing nc_output_path
+    """
+    if not os.path.exists(raw_data_path):
+        raise FileNotFoundError(f"{raw_data_path} does not exist")
+    if os.path.exists(nc_output_path):
+        raise FileExistsError(f"{nc_output_path} already exists")
+
+    params.clear()
+    params.update({
+        "raw_data_path": raw_data_path,
+        "nc_output_path": nc_output_path,
+        # per batch so concurrent jobs never share a mask file
+        "tmp_dir": f"{os.path.splitext(nc_output_path)[0]}_tmp"
+    })
+    os.makedirs(params["tmp_dir"], exist_ok=True)
+
+    print(f"starting l2gen on files at {params['raw_data_path']}, outputting to {params['nc_output_path']}")
+    try:
+        run_l2gen(params['raw_data_path'])
+    finally:
+        # the full scene mask is only needed by l2gen, a cached copy is a separate link that stays
+        shutil.rmtree(params["tmp_dir"], ignore_errors=True)
+
+def main():
+    if len(sys.argv) < 3:
+        print("Usage: python3 new_l2gen.py <raw_data_path> <nc_output_path>")
+        sys.exit(1)
+    try:
+        run(sys.argv[1], sys.argv[2])
+    except (FileNotFoundError, FileExistsError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
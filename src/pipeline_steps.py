@@ -0,0 +1,120 @@
+import importlib
+import os
+import shutil
+from metrics import concurrent_rss_bytes, rusage_metrics
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Format: (script_name, display_label, input_ext, output_ext)
+PROCESSING_STEPS = [
+    ("tar_extraction.py", "Extracting TAR.GZ", ".tar.gz", ""),         # outputs folder
+    ("new_l2gen.py", "Running l2gen", "", ".nc"),                         # folder → .nc
+    ("seadas_gpt.py", "Running SeaDAS GPT", ".nc", "")                    # .nc → folder
+]
+
+# Worker threads per entry in PROCESSING_STEPS, overridable from the environment
+STEP_WORKERS = {
+    "tar_extraction.py": int(os.environ.get("VIBRANTSEAS_EXTRACT_WORKERS", 2)),
+    "new_l2gen.py": int(os.environ.get("VIBRANTSEAS_L2GEN_WORKERS", 1)),
+    "seadas_gpt.py": int(os.environ.get("VIBRANTSEAS_GPT_WORKERS", 1)),
+}
+
+# Seconds a step may run before it is stopped (0 for no limit), overridable from the environment
+STEP_TIMEOUTS = {
+    "tar_extraction.py": float(os.environ.get("VIBRANTSEAS_EXTRACT_TIMEOUT", 3600)),
+    "new_l2gen.py": float(os.environ.get("VIBRANTSEAS_L2GEN_TIMEOUT", 6 * 3600)),
+    "seadas_gpt.py": float(os.environ.get("VIBRANTSEAS_GPT_TIMEOUT", 6 * 3600)),
+}
+
+# Steps run as a fork of the driving process calling the script's run() function instead of a fresh
+# python3, so numpy, netCDF4 and GDAL are imported once rather than on every step
+FORK_STAGES = os.environ.get("VIBRANTSEAS_FORK_STAGES", "1") == "1"
+
+# run() of every step module, filled in by load_stage_functions()
+STAGE_FUNCTIONS = {}
+
+def load_stage_functions():
+    """
+    imports every step's module ahead of time, steps whose module fails to import run as python3 scripts
+    """
+    if not FORK_STAGES:
+        return STAGE_FUNCTIONS
+    for script, *_ in PROCESSING_STEPS:
+        try:
+            STAGE_FUNCTIONS[script] = importlib.import_module(os.path.splitext(script)[0]).run
+        except Exception as e:
+            print(f"Warning: running {script} as a subprocess, importing it failed: {e}")
+    return STAGE_FUNCTIONS
+
+def step_output_path(i, base):
+    """
+    where PROCESSING_STEPS[i] writes its output for the job whose paths start with base
+    """
+    script, label, input_ext, output_ext = PROCESSING_STEPS[i]
+    return f"{base}_{label.replace(' ', '_').lower()}{output_ext}"
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def run_step(supervisor, i, name, current_input, output_path, on_lines, env=None):
+    """
+    runs PROCESSING_STEPS[i] under the supervisor with its timeout, forked when its stage function
+    is loaded and as a python3 subprocess otherwise, and returns the supervisor's result
+    """
+    script = PROCESSING_STEPS[i][0]
+    timeout = STEP_TIMEOUTS.get(script) or None
+    function = STAGE_FUNCTIONS.get(script)
+    if function is None:
+        return supervisor.run(
+            ['python3', os.path.join(SCRIPTS_DIR, script), current_input, output_path],
+            name,
+            on_lines,
+            timeout=timeout,
+            # Unbuffered so the steps' print() output reaches the log as it happens
+            env=dict(os.environ, PYTHONUNBUFFERED="1", **(env or {}))
+        )
+    return supervisor.run_function(function, (current_input, output_path), name, on_lines, timeout=timeout, env=env)
+
+def step_metrics(i, result, tools):
+    """
+    wall time, outcome and resource use of one run of PROCESSING_STEPS[i] (from wait4, so it
+    includes the tools the step ran) along with the per tool records the step wrote, and
+    peak_memory_bytes, which also counts tools that ran at the same time
+    """
+    script, label, input_ext, output_ext = PROCESSING_STEPS[i]
+    if result['timed_out']:
+        outcome = "timed_out"
+    elif result['returncode'] != 0:
+        outcome = "failed"
+    else:
+        outcome = "ok"
+    step = {
+        "stage": i,
+        "step": label,
+        "script": script,
+        "outcome": outcome,
+        "returncode": result['returncode'],
+        "wall_time": result['wall_time'],
+    }
+    step.update(rusage_metrics(result['rusage']))
+    # what the step needs next to other steps, tools it ran at the same time add up
+    step['peak_memory_bytes'] = step['max_rss_bytes']
+    if step['max_rss_bytes'] is not None:
+        step['peak_memory_bytes'] = max(step['max_rss_bytes'], concurrent_rss_bytes(tools))
+    step['tools'] = tools
+    return step
+
+def step_summary(step):
+    """
+    one line account of a step's resource use for the job log
+    """
+    if step['user_time'] is None:
+        return f"{step['step']} took {step['wall_time']:.1f}s"
+    return (
+        f"{step['step']} took {step['wall_time']:.1f}s, {step['user_time'] + step['sys_time']:.1f}s CPU, "
+        f"peak RSS {step['max_rss_bytes'] / 1e6:.0f} MB, read {step['read_bytes'] / 1e6:.0f} MB, "
+        f"wrote {step['write_bytes'] / 1e6:.0f} MB"
+    )
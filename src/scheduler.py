@@ -0,0 +1,122 @@
+import heapq
+import itertools
+import threading
+
+
+class JobScheduler:
+    """
+    staged pipeline scheduler: every stage has its own priority queue (FIFO within a priority)
+    and its own fixed pool of worker threads, so different jobs can occupy different stages at once
+
+    run_stage(stage, batchname, payload) runs one stage for a job and returns the payload for the
+    next stage, or None to stop the job there (failure or last stage)
+
+    with estimate_memory(stage, batchname, payload) and a memory_budget in bytes, a job only starts
+    once its estimate fits next to those of the running jobs (or nothing else is running)
+    """
+
+    def __init__(self, stage_workers, run_stage, on_queue_change=None, estimate_memory=None, memory_budget=0):
+        self.stage_workers = stage_workers
+        self.run_stage = run_stage
+        self.on_queue_change = on_queue_change
+        self.estimate_memory = estimate_memory
+        self.memory_budget = memory_budget
+        self.memory_reserved = 0
+        self._estimates = {}
+        self._queues = [[] for _ in stage_workers]
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._workers = []
+        for stage, count in enumerate(stage_workers):
+            for i in range(max(1, count)):
+                worker = threading.Thread(
+                    target=self._worker, args=(stage,), name=f"stage-{stage}-worker-{i}", daemon=True
+                )
+                worker.start()
+                self._workers.append(worker)
+
+    def submit(self, batchname, payload, priority=0, stage=0):
+        """
+        queues batchname at stage with payload, lower priority values run first
+        """
+        estimate = 0
+        if self.estimate_memory and self.memory_budget:
+            try:
+                estimate = self.estimate_memory(stage, batchname, payload)
+            except Exception as e:
+                print(f"Warning: could not estimate the memory of {batchname} in stage {stage}: {e}")
+        with self._cond:
+            self._estimates[(stage, batchname)] = estimate
+            heapq.heappush(self._queues[stage], (priority, next(self._counter), batchname, payload))
+            self._cond.notify_all()
+        self._notify_queue_change(stage)
+
+    def cancel(self, batchname):
+        """
+        removes a job waiting in any stage queue, returns True if it was queued
+        """
+        changed = []
+        with self._cond:
+            for stage, queue in enumerate(self._queues):
+                remaining = [entry for entry in queue if entry[2] != batchname]
+                if len(remaining) != len(queue):
+                    self._estimates.pop((stage, batchname), None)
+                    heapq.heapify(remaining)
+                    self._queues[stage] = remaining
+                    changed.append(stage)
+        for stage in changed:
+            self._notify_queue_change(stage)
+        return bool(changed)
+
+    def queued(self, stage=0):
+        """
+        batchnames waiting for a worker of stage, in the order they will start
+        """
+        with self._cond:
+            return [entry[2] for entry in sorted(self._queues[stage])]
+
+    def position(self, batchname):
+        """
+        (stage, 1-based queue position) of batchname or None if it is not queued
+        """
+        for stage in range(len(self._queues)):
+            queued = self.queued(stage)
+            if batchname in queued:
+                return stage, queued.index(batchname) + 1
+        return None
+
+    def _fits(self, stage):
+        """
+        whether the next job of stage fits in the memory budget, call with the lock held
+        """
+        if not self.memory_budget or not self.memory_reserved:
+            return True
+        batchname = self._queues[stage][0][2]
+        return self.memory_reserved + self._estimates.get((stage, batchname), 0) <= self.memory_budget
+
+    def _notify_queue_change(self, stage):
+        if self.on_queue_change:
+            self.on_queue_change(stage, self.queued(stage))
+
+    def _worker(self, stage):
+        queue = self._queues
+        while True:
+            with self._cond:
+                while not queue[stage] or not self._fits(stage):
+                    self._cond.wait()
+                priority, _, batchname, payload = heapq.heappop(queue[stage])
+                estimate = self._estimates.pop((stage, batchname), 0)
+                self.memory_reserved += estimate
+            self._notify_queue_change(stage)
+            try:
+                result = self.run_stage(stage, batchname, payload)
+            except Exception as e:
+                print(f"Warning: job {batchname} raised {e} in stage {stage}")
+                continue
+            finally:
+                with self._cond:
+                    self.memory_reserved -= estimate
+                    # jobs held back by the budget may fit now
+                    self._cond.notify_all()
+            if result is not None and stage + 1 < len(queue):
+                self.submit(batchname, result, priority=priority, stage=stage + 1)
@@ -1,22 +1,31 @@
-import subprocess
 import os
 import json
-import sys
-
-if len(sys.argv) < 3:
-    print("Usage: python3 seadas_gpt.py <seadas_products_nc> <output_folder>")
-    sys.exit(1)
-
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+import cpd_renderer
+import metrics
 
 GPT_LOCATION = '/usr/local/seadas-7.5.3/bin/gpt.sh'
 COLOR_PALLETE_LOCATION = '/mit/color_palletes'
 
-seadas_products_nc = sys.argv[1]
+# sequential: one gpt.sh per image, one at a time
+# pool: one gpt.sh per image, at most --workers at a time
+# graph: a single gpt.sh run of a generated graph that reads the product once and writes every image
+# images with "renderer": "numpy" in image_attributes.json skip gpt.sh and use cpd_renderer instead
+RENDER_MODES = ('sequential', 'pool', 'graph')
+
+# sequential unless asked otherwise, every gpt.sh is a multi-GB JVM so running several at once is opt-in
+DEFAULT_MODE = os.environ.get('SEADAS_GPT_MODE', 'sequential')
+DEFAULT_WORKERS = int(os.environ.get('SEADAS_GPT_WORKERS', 2))
 
-output_folder = sys.argv[2]
-os.makedirs(output_folder, exist_ok=True)
+IMAGE_ATTRIBUTES = '/mit/scripts/image_attributes.json'
 
-images = json.load(open('/mit/scripts/image_attributes.json'))
+# product, output folder and image_attributes.json of the run in progress, set by run()
+seadas_products_nc = None
+output_folder = None
+images = {}
 
 # /usr/local/seadas-7.5.3/bin/gpt.sh WriteImage -Ssource=/mit/seadas_products.nc -PcolourScaleMax=0.742 -PcolourScaleMin=0.103 -PcpdFilePath=/mit/gpt/diatoms.cpd -PfilePath=/mit/output.tif -PformatName=tif -PsourceBandName=diatoms_hirata
 def create_image(band, color_pallete, min, max, output_filename):
@@ -31,20 +40,143 @@ def create_image(band, color_pallete, min, max, output_filename):
         f'-PformatName=tiff',
         f'-PsourceBandName={band}'
     ]
-    
-    subprocess.run(cmd, check=True)
 
-def main():
+    # timed and measured per invocation, the server collects the records as step metrics
+    metrics.run_measured(cmd, label=output_filename)
+
+def render_image(image):
+    """
+    renders one entry of image_attributes.json with gpt.sh and returns how long it took in seconds
+    """
+    print('starting ', image, flush=True)
+    start = time.time()
+    band = images[image]['band']
+    color_pallete = images[image]['color_pallete']
+    min = images[image]['min']
+    max = images[image]['max']
+    output_filename = image
+    create_image(band, color_pallete, min, max, output_filename)
+    elapsed = time.time() - start
+    print(f'finished {image} in {elapsed:.1f}s', flush=True)
+    return elapsed
+
+def render_band_group(band, band_images):
+    """
+    renders every numpy image of one band from a single read of that band
+    """
+    print(f'starting {band} for {", ".join(band_images)}', flush=True)
+    start = time.time()
+    targets = [
+        {
+            'cpd_path': f"{COLOR_PALLETE_LOCATION}/{images[image]['color_pallete']}",
+            'min': images[image]['min'],
+            'max': images[image]['max'],
+            'output_path': os.path.join(output_folder, image),
+            'lut_size': images[image].get('lut_size', cpd_renderer.DEFAULT_LUT_SIZE),
+        }
+        for image in band_images
+    ]
+    cpd_renderer.render_band(seadas_products_nc, band, targets)
+    elapsed = time.time() - start
+    print(f'finished {band} ({len(band_images)} images) in {elapsed:.1f}s', flush=True)
+    return elapsed
+
+def write_graph(graph_path, gpt_images):
+    """
+    writes a gpt graph with one Read node feeding a WriteImage node per image in gpt_images
+    """
+    nodes = [
+        '  <node id="read">',
+        '    <operator>Read</operator>',
+        '    <parameters>',
+        f'      <file>{escape(seadas_products_nc)}</file>',
+        '    </parameters>',
+        '  </node>',
+    ]
+    for i, image in enumerate(gpt_images):
+        attributes = images[image]
+        nodes += [
+            f'  <node id="image{i}">',
+            '    <operator>WriteImage</operator>',
+            '    <sources>',
+            '      <source>read</source>',
+            '    </sources>',
+            '    <parameters>',
+            f'      <sourceBandName>{escape(attributes["band"])}</sourceBandName>',
+            f'      <colourScaleMin>{attributes["min"]}</colourScaleMin>',
+            f'      <colourScaleMax>{attributes["max"]}</colourScaleMax>',
+            f'      <cpdFilePath>{escape(COLOR_PALLETE_LOCATION)}/{escape(attributes["color_pallete"])}</cpdFilePath>',
+            f'      <filePath>{escape(os.path.join(output_folder, image))}</filePath>',
+            '      <formatName>tiff</formatName>',
+            '    </parameters>',
+            '  </node>',
+        ]
+    with open(graph_path, 'w') as graph:
+        graph.write('<graph id="seadas_gpt">\n  <version>1.0</version>\n')
+        graph.write('\n'.join(nodes))
+        graph.write('\n</graph>\n')
+
+def render_graph(gpt_images):
+    """
+    renders gpt_images in a single gpt.sh invocation so the JVM starts and the product is opened once
+    """
+    graph_path = os.path.join(output_folder, 'render_graph.xml')
+    write_graph(graph_path, gpt_images)
+    print(f'starting graph with {len(gpt_images)} images', flush=True)
+    start = time.time()
+    metrics.run_measured([GPT_LOCATION, graph_path], label='graph')
+    print(f'finished graph in {time.time() - start:.1f}s', flush=True)
+    os.remove(graph_path)
+
+def run(products_nc, output_dir, mode=None, workers=None):
+    """
+    stage function: renders every image in image_attributes.json from products_nc into output_dir
+    """
+    global seadas_products_nc, output_folder, images
+    mode = mode or DEFAULT_MODE
+    workers = workers or DEFAULT_WORKERS
+    if mode not in RENDER_MODES:
+        raise ValueError(f"unknown render mode {mode}, expected one of {', '.join(RENDER_MODES)}")
+
+    seadas_products_nc = products_nc
+    output_folder = output_dir
+    os.makedirs(output_folder, exist_ok=True)
+    with open(IMAGE_ATTRIBUTES) as f:
+        images = json.load(f)
+
+    start = time.time()
+
+    # numpy images are grouped by band so each band is read once for all of its palettes
+    bands = {}
+    gpt_images = []
     for image in images:
-        print('starting ', image)
-        band = images[image]['band']
-        color_pallete = images[image]['color_pallete']
-        min = images[image]['min']
-        max = images[image]['max']
-        output_filename = image
-        create_image(band, color_pallete, min, max, output_filename)
-        print('finished ', image)
-    print('done')
+        if images[image].get('renderer', 'gpt') == 'numpy':
+            bands.setdefault(images[image]['band'], []).append(image)
+        else:
+            gpt_images.append(image)
+    for band, band_images in bands.items():
+        render_band_group(band, band_images)
+
+    if mode == 'graph':
+        if gpt_images:
+            render_graph(gpt_images)
+    elif mode == 'pool' and workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # list() so a failed image raises here instead of being dropped
+            list(pool.map(render_image, gpt_images))
+    else:
+        for image in gpt_images:
+            render_image(image)
+    print(f'done in {time.time() - start:.1f}s')
+
+def main():
+    parser = argparse.ArgumentParser(usage="python3 seadas_gpt.py <seadas_products_nc> <output_folder> [--mode MODE] [--workers N]")
+    parser.add_argument('seadas_products_nc')
+    parser.add_argument('output_folder')
+    parser.add_argument('--mode', choices=RENDER_MODES, default=DEFAULT_MODE)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    args = parser.parse_args()
+    run(args.seadas_products_nc, args.output_folder, args.mode, args.workers)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,89 +1,245 @@
 import os
-import tarfile
-import threading
-import time
+import re
+import uuid
 from datetime import datetime
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Request, Response, request, jsonify, render_template
 from werkzeug.utils import secure_filename
-from collections import deque
-import subprocess
 import shutil
+from scheduler import JobScheduler
+from supervisor import ProcessSupervisor
+from metrics import BYTES_BUCKETS, CHILD_METRICS_ENV, SECONDS_BUCKETS, Histogram, read_child_records
+# Step definitions live in pipeline_steps so backfill.py runs the same steps
+import pipeline_steps
+from pipeline_steps import (
+    PROCESSING_STEPS, STEP_WORKERS, load_stage_functions, remove_path, run_step, step_metrics, step_summary
+)
+from job_store import JobStore
+from memory_model import MEMORY_BUDGET, MemoryModel
+from job_events import LOG_LEVELS, EventBus, JobLog, filter_records, line_level, sse
+from tar_extraction import SELECTIVE_EXTRACTION, StreamingExtractor
 
 SCRIPTS_LOCATION = "/workspace/src"
 
+# Extract .tar.gz uploads while the request body is still arriving instead of saving them first
+STREAM_EXTRACTION = os.environ.get("VIBRANTSEAS_STREAM_EXTRACTION", "1") == "1"
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # The batch name may come after the file in the form, so extract into a staging folder
+        if STREAM_EXTRACTION and self.path == '/upload' and filename and filename.endswith('.tar.gz'):
+            staging = os.path.join(app.config['UPLOAD_FOLDER'], f".incoming-{uuid.uuid4().hex}")
+            extractor = StreamingExtractor(staging, selective=SELECTIVE_EXTRACTION)
+            self.extractors = getattr(self, 'extractors', []) + [extractor]
+            return extractor
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
 app = Flask(__name__, static_folder='static', template_folder='templates')
+app.request_class = UploadRequest
 app.config['UPLOAD_FOLDER'] = 'uploads/'
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# In-memory job store
+@app.teardown_request
+def discard_staged_uploads(exc):
+    # Staging folders that were not handed to a job (rejected or failed uploads)
+    for extractor in getattr(request, 'extractors', []):
+        extractor.close()
+        shutil.rmtree(extractor.dump_path, ignore_errors=True)
+
+# In-memory job store, mirrored to SQLite so jobs survive restarts
 JOBS = {}
+# Status changes and deletions pushed to /events subscribers
+JOB_EVENTS = EventBus()
 
+# Seconds between keep-alive comments on idle event streams
+SSE_HEARTBEAT = 15
+job_store = JobStore(os.environ.get("VIBRANTSEAS_JOB_DB", os.path.join(app.config['UPLOAD_FOLDER'], ".jobs.sqlite3")))
 
-# Format: (script_name, display_label, input_ext, output_ext)
-PROCESSING_STEPS = [
-    ("tar_extraction.py", "Extracting TAR.GZ", ".tar.gz", ""),         # outputs folder
-    ("new_l2gen.py", "Running l2gen", "", ".nc"),                         # folder → .nc
-    ("seadas_gpt.py", "Running SeaDAS GPT", ".nc", "")                    # .nc → folder
-]
+# Runs every step's child process (and the tools it starts) on one event loop thread
+supervisor = ProcessSupervisor()
 
-def stream_subprocess(command, batchname):
-    process = subprocess.Popen(
-        command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
-        bufsize=1,
-        universal_newlines=True
-    )
+# Import the step modules (numpy, netCDF4, GDAL) once so every forked step starts warm
+load_stage_functions()
 
-    for line in process.stdout:
-        JOBS[batchname]['logs'].append(line.strip())
+# Served at /metrics, per job figures are kept in the job store and served at /jobs/<batchname>/metrics
+STEP_WALL_SECONDS = Histogram("vibrantseas_step_wall_seconds", "Wall time of pipeline steps", SECONDS_BUCKETS, ("step", "outcome"))
+STEP_CPU_SECONDS = Histogram("vibrantseas_step_cpu_seconds", "User plus system CPU time of pipeline steps", SECONDS_BUCKETS, ("step",))
+STEP_MAX_RSS_BYTES = Histogram("vibrantseas_step_max_rss_bytes", "Peak resident set size of pipeline steps", BYTES_BUCKETS, ("step",))
+STEP_READ_BYTES = Histogram("vibrantseas_step_read_bytes", "Bytes pipeline steps read from disk", BYTES_BUCKETS, ("step",))
+STEP_WRITE_BYTES = Histogram("vibrantseas_step_write_bytes", "Bytes pipeline steps wrote to disk", BYTES_BUCKETS, ("step",))
+TOOL_WALL_SECONDS = Histogram("vibrantseas_tool_wall_seconds", "Wall time of tools run by pipeline steps (gpt.sh)", SECONDS_BUCKETS, ("step", "command"))
+HISTOGRAMS = (STEP_WALL_SECONDS, STEP_CPU_SECONDS, STEP_MAX_RSS_BYTES, STEP_READ_BYTES, STEP_WRITE_BYTES, TOOL_WALL_SECONDS)
 
-    process.stdout.close()
-    return process.wait()
+# Log lines held in memory per job, every line is also written to the job's log file
+LOG_MEMORY_LINES = 2500
 
-def process_job(batchname, input_path):
-    base = os.path.join(app.config['UPLOAD_FOLDER'], batchname)
-    current_input = input_path
+def log_path(batchname):
+    return os.path.join(app.config['UPLOAD_FOLDER'], f"{batchname}.log")
 
-    for i, (script, label, input_ext, output_ext) in enumerate(PROCESSING_STEPS):
-        JOBS[batchname]['status'] = label
-        
-        JOBS[batchname]['logs'].append(f"{label} started")
+def job_summary(job):
+    return {k: v for k, v in job.items() if k not in ("logs", "generation")}
 
-        # Build output path
-        if output_ext == "":
-            output_path = f"{base}_{label.replace(' ', '_').lower()}"
-        else:
-            output_path = f"{base}_{label.replace(' ', '_').lower()}{output_ext}"
+def new_job(name, timestamp, status):
+    """
+    JOBS entry for an upload or a restored job, its generation tags the steps queued for this run
+    of the batch so a step of an earlier upload under the same name can tell it was replaced
+    """
+    return {
+        "name": name,
+        "timestamp": timestamp,
+        "status": status,
+        "logs": JobLog(maxlen=LOG_MEMORY_LINES, path=log_path(name)),
+        "generation": uuid.uuid4().hex
+    }
 
-        try:
-            exit_code = stream_subprocess(
-                ['python3', script, current_input, output_path],
-                batchname
-            )
-
-            if exit_code != 0:
-                JOBS[batchname]['status'] = f"Failed at {label}"
-                return
-            
-            # Delete current_input only if not the last step
-            if i < len(PROCESSING_STEPS) - 1:
-                try:
-                    if os.path.isdir(current_input):
-                        shutil.rmtree(current_input)
-                    elif os.path.exists(current_input):
-                        os.remove(current_input)
-                except Exception as cleanup_err:
-                    print(f"Warning: Failed to delete {current_input}: {cleanup_err}")
-
-            current_input = output_path
+def is_current(batchname, generation):
+    job = JOBS.get(batchname)
+    return job is not None and job['generation'] == generation
 
-        except Exception as e:
-            JOBS[batchname]['status'] = f"Error at {label}: {str(e)}"
-            return
+def set_status(batchname, status, finished=False):
+    JOBS[batchname]['status'] = status
+    job_store.set_status(batchname, status, finished)
+    JOB_EVENTS.publish({"type": "status", "job": job_summary(JOBS[batchname])})
+
+def update_queue_positions(stage, queued):
+    label = PROCESSING_STEPS[stage][1]
+    for position, batchname in enumerate(queued, start=1):
+        if batchname in JOBS:
+            if stage == 0:
+                set_status(batchname, f"Queued (position {position})")
+            else:
+                set_status(batchname, f"Queued for {label} (position {position})")
+
+def observe_step_metrics(step):
+    label = step['step']
+    STEP_WALL_SECONDS.observe(step['wall_time'], label, step['outcome'])
+    if step['user_time'] is not None:
+        STEP_CPU_SECONDS.observe(step['user_time'] + step['sys_time'], label)
+        STEP_MAX_RSS_BYTES.observe(step['max_rss_bytes'], label)
+        STEP_READ_BYTES.observe(step['read_bytes'], label)
+        STEP_WRITE_BYTES.observe(step['write_bytes'], label)
+    for tool in step['tools']:
+        TOOL_WALL_SECONDS.observe(tool['wall_time'], label, tool['command'])
+
+def record_step_metrics(i, batchname, result, tools):
+    step = step_metrics(i, result, tools)
+    if step['peak_memory_bytes'] is not None:
+        step['memory_estimate'] = memory_model.observe(i, batchname, step['peak_memory_bytes'])
+    job_store.add_metrics(batchname, i, step)
+    observe_step_metrics(step)
+    JOBS[batchname]['logs'].append(step_summary(step))
+
+def step_output_path(i, batchname):
+    return pipeline_steps.step_output_path(i, os.path.join(app.config['UPLOAD_FOLDER'], batchname))
+
+def process_step(i, batchname, payload):
+    """
+    runs PROCESSING_STEPS[i] for a job and returns the (generation, output path) payload of the
+    next step, or None if the job stops here
+    """
+    generation, current_input = payload
+    # Deleted or uploaded again since this step was queued
+    if not is_current(batchname, generation):
+        return None
+    logs = JOBS[batchname]['logs']
+
+    script, label, input_ext, output_ext = PROCESSING_STEPS[i]
+
+    set_status(batchname, label)
+    logs.append(f"{label} started")
+
+    output_path = step_output_path(i, batchname)
+    # The step appends a record per tool run (gpt.sh) here
+    tools_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{batchname}_step{i}_tools.jsonl")
+
+    try:
+        # Leftovers from a run interrupted by a restart
+        remove_path(output_path)
+        remove_path(tools_path)
+
+        result = run_step(
+            supervisor,
+            i,
+            batchname,
+            current_input,
+            output_path,
+            logs.extend,
+            env={CHILD_METRICS_ENV: os.path.abspath(tools_path)}
+        )
+
+        # Deleted or uploaded again while running, the paths now belong to the new run (or to delete_job)
+        if result['cancelled'] or not is_current(batchname, generation):
+            return None
+
+        record_step_metrics(i, batchname, result, read_child_records(tools_path))
+        remove_path(tools_path)
+
+        if result['timed_out']:
+            set_status(batchname, f"Timed out at {label}", finished=True)
+            return None
+
+        if result['returncode'] == -9:
+            # Not sent by the supervisor, so most likely the kernel's OOM killer
+            set_status(batchname, f"Failed at {label} (killed, likely out of memory)", finished=True)
+            return None
+
+        if result['returncode'] != 0:
+            set_status(batchname, f"Failed at {label}", finished=True)
+            return None
+
+        # Record the step before its input is deleted so a restart resumes from output_path
+        job_store.complete_step(batchname, i, output_path)
+
+        # Delete current_input only if not the last step
+        if i < len(PROCESSING_STEPS) - 1:
+            try:
+                remove_path(current_input)
+            except Exception as cleanup_err:
+                print(f"Warning: Failed to delete {current_input}: {cleanup_err}")
+
+    except Exception as e:
+        if is_current(batchname, generation):
+            set_status(batchname, f"Error at {label}: {str(e)}", finished=True)
+        return None
+
+    if i == len(PROCESSING_STEPS) - 1:
+        set_status(batchname, "Done", finished=True)
+        return None
+    return generation, output_path
+
+# Steps only start when their estimated peak memory fits in MEMORY_BUDGET next to the running ones
+memory_model = MemoryModel(job_store, PROCESSING_STEPS)
+
+scheduler = JobScheduler(
+    [STEP_WORKERS.get(script, 1) for script, *_ in PROCESSING_STEPS],
+    process_step,
+    on_queue_change=update_queue_positions,
+    # payloads are (generation, current input path)
+    estimate_memory=lambda stage, batchname, payload: memory_model.estimate(stage, batchname, payload[1]),
+    memory_budget=MEMORY_BUDGET
+)
+
+def restore_jobs():
+    """
+    reloads stored jobs and requeues unfinished ones at the first step they had not completed
+    """
+    for job in job_store.jobs():
+        name = job['name']
+        JOBS[name] = new_job(name, job['timestamp'], job['status'])
+        for step in job_store.metrics(name):
+            observe_step_metrics(step)
+        if job['finished']:
+            continue
+        if job['next_stage'] >= len(PROCESSING_STEPS):
+            set_status(name, "Done", finished=True)
+            continue
+        label = PROCESSING_STEPS[job['next_stage']][1]
+        JOBS[name]['logs'].append(f"Resuming at {label} after a server restart")
+        scheduler.submit(name, (JOBS[name]['generation'], job['current_input']), priority=job['priority'], stage=job['next_stage'])
+
+# With the debug reloader only the serving child process runs jobs
+if __name__ != '__main__' or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+    restore_jobs()
 
-    JOBS[batchname]['status'] = "Done"
 @app.route('/upload', methods=['POST'])
 def upload():
     if 'file' not in request.files or 'batchname' not in request.form:
@@ -95,22 +251,58 @@ def upload():
     if not file or file.filename == '':
         return jsonify({"error": "No file selected"}), 400
 
-    if not file.filename.endswith('.tar.gz'):
-        return jsonify({"error": "Only .tar.gz files allowed"}), 400
+    if not file.filename.endswith(('.tar.gz', '.tar')):
+        return jsonify({"error": "Only .tar.gz or .tar files allowed"}), 400
 
-    filename = f"{batchname}.tar.gz"
+    try:
+        priority = int(request.form.get('priority', 0))
+    except ValueError:
+        return jsonify({"error": "Priority must be an integer"}), 400
+
+    # Uncompressed .tar uploads can be staged by member index instead of extracted
+    filename = f"{batchname}.tar" if file.filename.endswith('.tar') else f"{batchname}.tar.gz"
     filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(filepath)
+    first_stage = 0
 
-    JOBS[batchname] = {
-        "name": batchname,
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "status": "Uploaded",
-        "logs": deque(maxlen=2500)
-    }
+    # A re-uploaded batch replaces the old run, so stop it before its files are reused
+    if batchname in JOBS:
+        scheduler.cancel(batchname)
+        supervisor.cancel(batchname)
+
+    if isinstance(file.stream, StreamingExtractor):
+        # The archive was extracted while it was uploaded, so the job starts after the extraction step
+        try:
+            file.stream.finish()
+        except Exception as e:
+            return jsonify({"error": f"Failed to extract {file.filename}: {e}"}), 400
+        filepath = step_output_path(0, batchname)
+        try:
+            # The extraction folder of an earlier upload of this batch may still be there
+            remove_path(filepath)
+            os.rename(file.stream.dump_path, filepath)
+        except OSError as e:
+            return jsonify({"error": f"Could not replace the files of {batchname}: {e}"}), 409
+        first_stage = 1
+    else:
+        file.save(filepath)
+
+    # A re-uploaded batch starts with a fresh log
+    if batchname in JOBS:
+        JOBS[batchname]['logs'].close()
+    remove_path(log_path(batchname))
+
+    JOBS[batchname] = new_job(batchname, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "Uploaded")
+    job_store.create(batchname, JOBS[batchname]['timestamp'], "Uploaded", priority, first_stage, filepath)
+    JOB_EVENTS.publish({"type": "status", "job": job_summary(JOBS[batchname])})
 
-    # Start background thread
-    threading.Thread(target=process_job, args=(batchname, filepath)).start()
+    if first_stage:
+        JOBS[batchname]['logs'].append(f"{PROCESSING_STEPS[0][1]} done while uploading")
+
+    # A re-uploaded batch may be a different scene
+    memory_model.forget(batchname)
+
+    # Queue for the first stage left to run, lower priority values run first
+    scheduler.submit(batchname, (JOBS[batchname]['generation'], filepath), priority=priority, stage=first_stage)
 
     return jsonify({"message": "Upload successful", "filename": filename})
 
@@ -120,7 +312,13 @@ def delete_job(batchname):
     if not job:
         return jsonify({"error": "Job not found"}), 404
 
-    # Remove uploaded tar.gz and all derived files
+    # Drop the job from the queue if it has not started yet, or stop the step it is running
+    scheduler.cancel(batchname)
+    supervisor.cancel(batchname)
+
+    job['logs'].close()
+
+    # Remove uploaded tar.gz, the log file and all derived files
     base = os.path.join(app.config['UPLOAD_FOLDER'], batchname)
     try:
         # Delete all files/folders that start with batchname
@@ -133,6 +331,9 @@ def delete_job(batchname):
                     os.remove(path)
 
         del JOBS[batchname]
+        job_store.delete(batchname)
+        memory_model.forget(batchname)
+        JOB_EVENTS.publish({"type": "deleted", "name": batchname})
         return jsonify({"message": f"Deleted job {batchname}"})
     except Exception as e:
         print(e)
@@ -144,18 +345,131 @@ def index():
 
 @app.route('/jobs', methods=['GET'])
 def jobs():
-    stripped = [
-        {k: v for k, v in job.items() if k != "logs"}
-        for job in JOBS.values()
-    ]
+    stripped = [job_summary(job) for job in JOBS.values()]
     return jsonify(stripped)
 
+def stream_cursor():
+    # EventSource sends Last-Event-ID when it reconnects, ?since= lets scripts resume explicitly
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('since') or 0
+    try:
+        return int(cursor)
+    except ValueError:
+        return 0
+
+@app.route('/events', methods=['GET'])
+def events():
+    """
+    server-sent job status changes, starting with a snapshot when the client has no usable cursor
+    """
+    # Event ids carry the bus epoch, so a client reconnecting after a restart gets a snapshot
+    cursor = JOB_EVENTS.cursor(request.headers.get('Last-Event-ID') or request.args.get('since') or 0)
+
+    def generate(seq):
+        missed = JOB_EVENTS.since(seq) if seq else None
+        if missed is None:
+            seq = JOB_EVENTS.last_seq
+            yield sse([job_summary(job) for job in list(JOBS.values())], event="snapshot", id=JOB_EVENTS.event_id(seq))
+            missed = []
+        while True:
+            for seq, event in missed:
+                yield sse(event, event=event["type"], id=JOB_EVENTS.event_id(seq))
+            JOB_EVENTS.wait(seq, SSE_HEARTBEAT)
+            missed = JOB_EVENTS.since(seq)
+            if missed is None:
+                # fell behind the event buffer, start over from a snapshot
+                seq = JOB_EVENTS.last_seq
+                yield sse([job_summary(job) for job in list(JOBS.values())], event="snapshot", id=JOB_EVENTS.event_id(seq))
+                missed = []
+            elif not missed:
+                yield ": keep-alive\n\n"
+
+    return Response(generate(cursor), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/logs/<batchname>/stream', methods=['GET'])
+def stream_logs(batchname):
+    """
+    server-sent log lines of a job newer than the client's cursor, ends when the job is deleted
+    """
+    job = JOBS.get(batchname)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    log = job['logs']
+
+    def generate(seq):
+        while JOBS.get(batchname) is job:
+            records = log.since(seq)
+            if records:
+                seq = records[-1][0]
+                yield sse([line for _, line in records], event="logs", id=seq)
+            else:
+                yield ": keep-alive\n\n"
+            log.wait(seq, SSE_HEARTBEAT)
+
+    return Response(generate(stream_cursor()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/jobs/<batchname>/metrics', methods=['GET'])
+def job_metrics(batchname):
+    """
+    wall time, CPU time, peak RSS and disk bytes of every step run of a job, with its gpt.sh runs
+    """
+    if batchname not in JOBS:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify({"name": batchname, "steps": job_store.metrics(batchname)})
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines += histogram.render()
+    lines += ["# HELP vibrantseas_queued_jobs Jobs waiting for a worker of each step", "# TYPE vibrantseas_queued_jobs gauge"]
+    for i, (script, label, input_ext, output_ext) in enumerate(PROCESSING_STEPS):
+        lines.append(f'vibrantseas_queued_jobs{{step="{label}"}} {len(scheduler.queued(i))}')
+    lines += [
+        "# HELP vibrantseas_memory_reserved_bytes Estimated peak memory of the running steps",
+        "# TYPE vibrantseas_memory_reserved_bytes gauge",
+        f"vibrantseas_memory_reserved_bytes {scheduler.memory_reserved}",
+        "# HELP vibrantseas_memory_budget_bytes Memory the running steps may be estimated to use",
+        "# TYPE vibrantseas_memory_budget_bytes gauge",
+        f"vibrantseas_memory_budget_bytes {scheduler.memory_budget}",
+    ]
+    return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
+
 @app.route('/logs/<batchname>', methods=['GET'])
 def get_logs(batchname):
+    """
+    log lines newer than ?since=<seq>, optionally only those at or above ?level= matching ?grep=
+    pass the returned last_seq as since on the next call to fetch only new lines
+    ?format=legacy returns the plain lines under "logs" instead of "records"
+    """
     job = JOBS.get(batchname)
     if not job:
         return jsonify({"error": "Job not found"}), 404
-    return jsonify({"logs": list(job['logs'])})
+
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({"error": "since must be an integer"}), 400
+    level = request.args.get('level') or None
+    if level and level not in LOG_LEVELS:
+        return jsonify({"error": f"level must be one of {', '.join(LOG_LEVELS)}"}), 400
+    try:
+        grep = re.compile(request.args['grep']) if request.args.get('grep') else None
+    except re.error as e:
+        return jsonify({"error": f"Invalid grep pattern: {e}"}), 400
+    legacy = request.args.get('format') == 'legacy'
+    if request.args.get('format') not in (None, 'legacy'):
+        return jsonify({"error": "format must be legacy or left out"}), 400
+
+    log = job['logs']
+    # Read the cursor first so lines appended while filtering are left for the next call
+    last_seq = log.last_seq
+    records = filter_records([r for r in log.since(since) if r[0] <= last_seq], level, grep)
+    if legacy:
+        return jsonify({"logs": [line for _, line in records], "last_seq": last_seq})
+    return jsonify({
+        "records": [{"seq": seq, "level": line_level(line), "line": line} for seq, line in records],
+        "last_seq": last_seq
+    })
 
 if __name__ == '__main__':
     app.run(debug=True)
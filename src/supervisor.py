@@ -0,0 +1,244 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+# Seconds a timed out or cancelled child gets between SIGTERM and SIGKILL
+KILL_GRACE = float(os.environ.get("VIBRANTSEAS_KILL_GRACE", 10))
+
+# How often running children are polled for exit, and how long output is drained after they exit
+REAP_INTERVAL = 0.1
+DRAIN_TIMEOUT = 1.0
+
+READ_SIZE = 65536
+
+def exit_code(status):
+    """
+    Popen style return code of a wait status, negative for a terminating signal
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+class _ForkedProcess:
+    """
+    the parts of Popen the supervisor uses, for a child forked by run_function
+    """
+
+    def __init__(self, pid, stdout):
+        self.pid = pid
+        self.stdout = stdout
+        self.returncode = None
+
+def _fork_function(function, args, env):
+    """
+    forks a child that runs function(*args) as the leader of a new session with stdout and stderr on
+    a pipe, returns a _ForkedProcess for it
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(write_fd)
+        return _ForkedProcess(pid, os.fdopen(read_fd, "rb"))
+
+    code = 1
+    try:
+        os.setsid()
+        os.dup2(write_fd, 1)
+        os.dup2(write_fd, 2)
+        # drop every other descriptor inherited from the server (client sockets, the job database)
+        for fd in os.listdir("/proc/self/fd"):
+            if int(fd) > 2:
+                try:
+                    os.close(int(fd))
+                except OSError:
+                    pass
+        # fresh streams, another thread of the parent may have held the old ones' locks at fork time
+        sys.stdout = open(1, "w", buffering=1, closefd=False)
+        sys.stderr = open(2, "w", buffering=1, closefd=False)
+        os.environ.update(env or {})
+        function(*args)
+        code = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            code = e.code or 0
+        else:
+            print(e.code)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+class _Child:
+    def __init__(self, process, on_lines):
+        self.process = process
+        self.on_lines = on_lines
+        self.buffer = b""
+        self.eof = None
+        self.done = None
+        self.timed_out = False
+        self.cancelled = False
+        self.rusage = None
+
+    def feed(self, data):
+        """
+        hands every complete line in data to on_lines at once, keeping a trailing partial line
+        """
+        lines = (self.buffer + data).split(b"\n")
+        self.buffer = lines.pop()
+        self.emit(lines)
+
+    def flush(self):
+        if self.buffer:
+            self.emit([self.buffer])
+            self.buffer = b""
+
+    def emit(self, lines):
+        if not lines:
+            return
+        try:
+            self.on_lines([line.decode(errors="replace").strip() for line in lines])
+        except Exception as e:
+            print(f"Warning: log handler of pid {self.process.pid} raised {e}")
+
+class ProcessSupervisor:
+    """
+    runs child processes on a single asyncio event loop thread: output is read without a thread per
+    child and handed over a chunk of lines at a time, with per-run timeouts and cancellation by name
+
+    every child leads its own process group, so timeouts and cancellation also stop the tools it
+    starts (gpt.sh, l2gen)
+    """
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._running = {}
+        thread = threading.Thread(target=self._loop.run_forever, name="process-supervisor", daemon=True)
+        thread.start()
+
+    def run(self, command, name, on_lines, timeout=None, **popen_kwargs):
+        """
+        runs command to completion under name, calling on_lines(lines) from the loop thread as
+        output arrives, and returns a dict with returncode, timed_out, cancelled, wall_time and
+        rusage (from wait4)
+        """
+        def spawn():
+            return subprocess.Popen(
+                command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True, **popen_kwargs
+            )
+        future = asyncio.run_coroutine_threadsafe(self._run(spawn, name, on_lines, timeout), self._loop)
+        return future.result()
+
+    def run_function(self, function, args, name, on_lines, timeout=None, env=None):
+        """
+        like run, but runs function(*args) in a child forked from this process, so it starts with
+        every module already imported here, with env added to its environment
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self._run(lambda: _fork_function(function, args, env), name, on_lines, timeout), self._loop
+        )
+        return future.result()
+
+    def cancel(self, name):
+        """
+        stops every child running under name and waits for them to exit, returns True if any ran
+        """
+        return asyncio.run_coroutine_threadsafe(self._cancel(name), self._loop).result()
+
+    def running(self, name):
+        return bool(self._running.get(name))
+
+    async def _run(self, spawn, name, on_lines, timeout):
+        start = time.perf_counter()
+        process = spawn()
+        child = _Child(process, on_lines)
+        child.eof = self._loop.create_future()
+        fd = process.stdout.fileno()
+        os.set_blocking(fd, False)
+        self._loop.add_reader(fd, self._read, child)
+        child.done = self._loop.create_task(self._reap(child))
+        self._running.setdefault(name, set()).add(child)
+
+        try:
+            await asyncio.wait({child.done}, timeout=timeout)
+            if not child.done.done():
+                child.timed_out = True
+                on_lines([f"Timed out after {timeout:g} s, stopping"])
+                self._terminate(child)
+            await child.done
+        finally:
+            self._running[name].discard(child)
+            if not self._running[name]:
+                del self._running[name]
+
+        return {
+            "returncode": process.returncode,
+            "timed_out": child.timed_out,
+            "cancelled": child.cancelled,
+            "wall_time": time.perf_counter() - start,
+            "rusage": child.rusage,
+        }
+
+    def _read(self, child):
+        try:
+            data = os.read(child.process.stdout.fileno(), READ_SIZE)
+        except BlockingIOError:
+            return
+        if data:
+            child.feed(data)
+            return
+        self._loop.remove_reader(child.process.stdout.fileno())
+        if not child.eof.done():
+            child.eof.set_result(None)
+
+    async def _reap(self, child):
+        """
+        polls the child for exit with wait4, then drains whatever output is left
+        """
+        pid = child.process.pid
+        while True:
+            reaped, status, rusage = os.wait4(pid, os.WNOHANG)
+            if reaped:
+                break
+            await asyncio.sleep(REAP_INTERVAL)
+        child.process.returncode = exit_code(status)
+        child.rusage = rusage
+
+        # a tool left running in the background can hold the pipe open, so do not wait for EOF forever
+        await asyncio.wait({child.eof}, timeout=DRAIN_TIMEOUT)
+        if not child.eof.done():
+            self._loop.remove_reader(child.process.stdout.fileno())
+            self._read(child)
+        child.flush()
+        child.process.stdout.close()
+
+    def _terminate(self, child):
+        self._signal(child, signal.SIGTERM)
+        self._loop.call_later(KILL_GRACE, self._kill, child)
+
+    def _kill(self, child):
+        if not child.done.done():
+            self._signal(child, signal.SIGKILL)
+
+    def _signal(self, child, sig):
+        try:
+            os.killpg(child.process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    async def _cancel(self, name):
+        children = list(self._running.get(name, ()))
+        for child in children:
+            child.cancelled = True
+            self._terminate(child)
+        if children:
+            await asyncio.wait({child.done for child in children})
+        return bool(children)
@@ -1,39 +1,398 @@
 import sys
 import tarfile
 import os
+import re
+import json
+import shutil
+import fnmatch
+import subprocess
+import threading
+
+# pigz decompresses on separate read/inflate/write threads, python's gzip module is the fallback
+PIGZ = shutil.which("pigz")
+
+# extraction filter that blocks absolute paths and links outside dump_path where tarfile supports it
+EXTRACT_KWARGS = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+
+# Selective extraction only writes the members listed in the manifest:
+#   always: name patterns that are always extracted (the MTL and the water mask)
+#   mtl_fields: MTL fields naming the files l2gen reads for the configured products
+#   before_mtl: name patterns used for members that come before the MTL in a streamed archive
+SELECTIVE_EXTRACTION = os.environ.get("VIBRANTSEAS_SELECTIVE_EXTRACTION", "0") == "1"
+MANIFEST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "extraction_manifest.json")
+
+# Index mode leaves an uncompressed archive whole: it is linked into dump_path next to an index of
+# member offsets, and downstream steps read members in place or materialize only what they need
+INDEX_EXTRACTION = os.environ.get("VIBRANTSEAS_INDEX_EXTRACTION", "0") == "1"
+ARCHIVE_NAME = "archive.tar"
+INDEX_NAME = "archive_index.json"
+
+# magic numbers of compressed archives, which can not be read by offset
+COMPRESSED_MAGIC = (b"\x1f\x8b", b"BZh", b"\xfd7zXZ", b"\x28\xb5\x2f\xfd")
+
+MTL_FIELD_PATTERN = re.compile(r'^\s*(\w+)\s*=\s*"?([^"\n]*)"?\s*$', re.MULTILINE)
+
+def normalized_member_name(name):
+    """
+    name a member is extracted under, top level .tif files get the .TIF extension l2gen expects
+    (this used to be a separate rename pass over the dump directory after extracting)
+    """
+    if "/" not in name.lstrip("./"):
+        base, ext = os.path.splitext(name)
+        if ext == '.tif':
+            return base + ext.upper()
+    return name
+
+def _matches(name, patterns):
+    name = os.path.basename(name).lower()
+    return any(fnmatch.fnmatchcase(name, pattern.lower()) for pattern in patterns)
+
+class MemberSelector:
+    """
+    decides which archive members selective extraction writes, based on the manifest and the MTL
+    """
+
+    def __init__(self, manifest=None):
+        if manifest is None:
+            with open(MANIFEST_PATH) as f:
+                manifest = json.load(f)
+        self.manifest = manifest
+        self.required = None
+        self.provisional = []
+        self.skipped = []
+
+    def read_mtl(self, mtl_text):
+        """
+        collects the files named by the manifest's MTL fields
+        """
+        self.required = {
+            value.strip().lower()
+            for field, value in MTL_FIELD_PATTERN.findall(mtl_text)
+            if _matches(field, self.manifest["mtl_fields"])
+        }
+
+    def wants(self, member):
+        if not member.isfile():
+            return member.isdir()
+        if _matches(member.name, self.manifest["always"]):
+            return True
+        if self.required is not None:
+            return os.path.basename(member.name).lower() in self.required
+        if _matches(member.name, self.manifest["before_mtl"]):
+            self.provisional.append(member)
+            return True
+        return False
+
+    def skip(self, member):
+        self.skipped.append(member)
+
+    def finish(self, dump_path):
+        """
+        removes members extracted before the MTL that it turned out not to need and reports skips
+        """
+        if self.required is not None:
+            for member in self.provisional:
+                if os.path.basename(member.name).lower() not in self.required:
+                    os.remove(os.path.join(dump_path, member.name))
+                    self.skipped.append(member)
+        if self.skipped:
+            skipped_bytes = sum(member.size for member in self.skipped)
+            print(f"Skipped {len(self.skipped)} members ({skipped_bytes / 1e6:.1f} MB) not needed by l2gen:")
+            for member in self.skipped:
+                print(f"  {member.name}")
+
+def extract_stream(fileobj, dump_path, mode="r|gz", selector=None):
+    """
+    extracts a tar stream member by member as it is read, without seeking
+    with a selector only the members it wants are written
+    """
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        for member in tar:
+            member.name = normalized_member_name(member.name)
+            if selector and not selector.wants(member):
+                selector.skip(member)
+                continue
+            tar.extract(member, path=dump_path, **EXTRACT_KWARGS)
+            if selector and selector.required is None and member.name.lower().endswith("mtl.txt"):
+                with open(os.path.join(dump_path, member.name)) as mtl:
+                    selector.read_mtl(mtl.read())
+    if selector:
+        selector.finish(dump_path)
+
+def _open_decompressed(tar_path):
+    """
+    (reader, tarfile mode, pigz process or None) for streaming through a .tar.gz or .tar on disk
+    """
+    with open(tar_path, "rb") as f:
+        gzipped = f.read(2) == COMPRESSED_MAGIC[0]
+    if PIGZ and gzipped:
+        pigz = subprocess.Popen([PIGZ, "-dc", tar_path], stdout=subprocess.PIPE)
+        return pigz.stdout, "r|", pigz
+    return open(tar_path, "rb"), "r|gz" if gzipped else "r|*", None
+
+def read_mtl(tar_path):
+    """
+    streams through the archive until the MTL and returns its text without writing anything
+    """
+    reader, mode, pigz = _open_decompressed(tar_path)
+    try:
+        with tarfile.open(fileobj=reader, mode=mode) as tar:
+            for member in tar:
+                if member.isfile() and member.name.lower().endswith("mtl.txt"):
+                    return tar.extractfile(member).read().decode()
+    finally:
+        reader.close()
+        if pigz:
+            pigz.kill()
+            pigz.wait()
+    return None
+
+def extract(tar_path, dump_path, selective=False):
+    """
+    extracts a .tar.gz on disk into dump_path, with selective only the members l2gen needs
+    """
+    os.makedirs(dump_path, exist_ok=True)
+    selector = None
+    if selective:
+        selector = MemberSelector()
+        # parsing the MTL first means no member has to be extracted provisionally
+        mtl_text = read_mtl(tar_path)
+        if mtl_text:
+            selector.read_mtl(mtl_text)
+
+    reader, mode, pigz = _open_decompressed(tar_path)
+    try:
+        extract_stream(reader, dump_path, mode, selector)
+    finally:
+        reader.close()
+    if pigz and pigz.wait() != 0:
+        raise RuntimeError(f"pigz failed to decompress {tar_path}")
+
+def is_indexable(tar_path):
+    """
+    True for uncompressed tar archives, whose members sit at fixed offsets
+    """
+    with open(tar_path, "rb") as f:
+        head = f.read(6)
+    return not head.startswith(COMPRESSED_MAGIC) and tarfile.is_tarfile(tar_path)
+
+def build_index(tar_path):
+    """
+    maps every regular member (under its normalized name) to its data offset and size
+    """
+    index = {}
+    with tarfile.open(tar_path, "r:") as tar:
+        for member in tar:
+            if member.isfile():
+                index[normalized_member_name(member.name)] = {"offset": member.offset_data, "size": member.size}
+    return index
+
+def stage_archive(tar_path, dump_path):
+    """
+    links the archive into dump_path and persists its member index beside it
+    """
+    os.makedirs(dump_path, exist_ok=True)
+    index = build_index(tar_path)
+    # the original stays until the step is recorded, the caller's input cleanup deletes it, so a
+    # restart before then can still run this stage again from tar_path
+    archive_path = os.path.join(dump_path, ARCHIVE_NAME)
+    if os.path.exists(archive_path):
+        os.remove(archive_path)
+    try:
+        os.link(tar_path, archive_path)
+    except OSError:
+        shutil.copy2(tar_path, archive_path)
+    with open(os.path.join(dump_path, INDEX_NAME), "w") as f:
+        json.dump(index, f)
+    print(f"Indexed {len(index)} members, nothing extracted")
+
+def load_index(dump_path):
+    """
+    the member index of a staged archive, or None if dump_path holds extracted files
+    """
+    index_path = os.path.join(dump_path, INDEX_NAME)
+    if not os.path.isfile(index_path):
+        return None
+    with open(index_path) as f:
+        return json.load(f)
+
+def member_path(dump_path, name, index):
+    """
+    GDAL virtual path reading a member straight out of the staged archive
+    """
+    entry = index[name]
+    archive = os.path.abspath(os.path.join(dump_path, ARCHIVE_NAME))
+    return f"/vsisubfile/{entry['offset']}_{entry['size']},{archive}"
+
+class _RangeReader:
+    """
+    read-only file object over size bytes of a file starting at offset
+    """
+
+    def __init__(self, path, offset, size):
+        self.file = open(path, "rb")
+        self.file.seek(offset)
+        self.remaining = size
+
+    def read(self, n=-1):
+        if n is None or n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self.file.read(n)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+VSISUBFILE_PATTERN = re.compile(r"^/vsisubfile/(\d+)_(\d+),(.*)$")
+
+def open_input(path):
+    """
+    opens a regular path or a /vsisubfile/ member path from member_path for reading
+    """
+    match = VSISUBFILE_PATTERN.match(path)
+    if match:
+        return _RangeReader(match.group(3), int(match.group(1)), int(match.group(2)))
+    return open(path, "rb")
+
+def materialize(dump_path, name, index):
+    """
+    copies one member out of the staged archive for tools that need a real file, once
+    """
+    dest = os.path.join(dump_path, name)
+    if not os.path.exists(dest):
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open_input(member_path(dump_path, name, index)) as src, open(dest + ".part", "wb") as out:
+            shutil.copyfileobj(src, out)
+        os.rename(dest + ".part", dest)
+    return dest
+
+class StreamingExtractor:
+    """
+    writable file object that extracts a .tar.gz while it is being written, used as the upload
+    stream so extraction overlaps with receiving the request body
+
+    werkzeug's form parser only needs write() and seek(), call finish() once the body is read
+    """
+
+    def __init__(self, dump_path, selective=False):
+        self.dump_path = dump_path
+        self.selector = MemberSelector() if selective else None
+        os.makedirs(dump_path, exist_ok=True)
+        self.error = None
+        self.pigz = None
+        if PIGZ:
+            self.pigz = subprocess.Popen([PIGZ, "-dc"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self._writer, reader, mode = self.pigz.stdin, self.pigz.stdout, "r|"
+        else:
+            read_fd, write_fd = os.pipe()
+            self._writer, reader, mode = os.fdopen(write_fd, "wb"), os.fdopen(read_fd, "rb"), "r|gz"
+        self._thread = threading.Thread(target=self._extract, args=(reader, mode), daemon=True)
+        self._thread.start()
+
+    def _extract(self, reader, mode):
+        try:
+            extract_stream(reader, self.dump_path, mode, self.selector)
+            # drain anything after the end of archive marker so the writer never blocks
+            while reader.read(65536):
+                pass
+        except Exception as e:
+            self.error = e
+            # keep draining so the writer is not stuck on a full pipe, finish() reports the error
+            try:
+                while reader.read(65536):
+                    pass
+            except Exception:
+                pass
+        finally:
+            reader.close()
+
+    def write(self, data):
+        if self.error is None:
+            try:
+                self._writer.write(data)
+            except BrokenPipeError as e:
+                self.error = e
+        return len(data)
+
+    def seek(self, *args):
+        return 0
+
+    def read(self, *args):
+        return b""
+
+    def readline(self, *args):
+        return b""
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        """
+        waits for the rest of the archive to be extracted and raises if extraction failed
+        """
+        if self._writer.closed:
+            return
+        try:
+            self._writer.close()
+        except BrokenPipeError:
+            pass
+        self._thread.join()
+        if self.pigz and self.pigz.wait() != 0 and self.error is None:
+            self.error = RuntimeError("pigz failed to decompress the upload")
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        try:
+            self.finish()
+        except Exception:
+            pass
+
+def run(tar_path, dump_path, selective=None, index=None):
+    """
+    stage function: extracts tar_path into dump_path, or with index stages an uncompressed archive
+    """
+    selective = SELECTIVE_EXTRACTION if selective is None else selective
+    index = INDEX_EXTRACTION if index is None else index
+
+    if not os.path.exists(tar_path):
+        raise FileNotFoundError(f"{tar_path} does not exist")
+
+    if index:
+        if is_indexable(tar_path):
+            print(f"Staging {tar_path} in {dump_path}")
+            stage_archive(tar_path, dump_path)
+            print("Done")
+            return
+        print(f"{tar_path} is compressed and can not be read by offset, extracting instead")
 
-if len(sys.argv) != 3:
-    print("Usage: python3 tar_extraction.py <tar_path> <dump_path>")
-    sys.exit(1)
-
-tar_path = sys.argv[1]
-dump_path = sys.argv[2]
-
-if not os.path.exists(tar_path):
-    print(f"Error: {tar_path} does not exist")
-    sys.exit(1)
-
-if not os.path.exists(dump_path):
-    os.makedirs(dump_path)
-    
-    
-def convert_extensions_to_lowercase(directory):
-    for filename in os.listdir(directory):
-        file_path = os.path.join(directory, filename)
-        if os.path.isfile(file_path):
-            base, ext = os.path.splitext(filename)
-            if ext == '.tif':
-                new_filename = base + ext.upper()
-                new_file_path = os.path.join(directory, new_filename)
-                os.rename(file_path, new_file_path)
-with tarfile.open(tar_path, "r:gz") as tar:
-    
     print(f"Extracting {tar_path} to {dump_path}")
-    tar.extractall(path=dump_path)
-    
-    print("Done")
-    
-    print("Fixing file extension case")
-    convert_extensions_to_lowercase(dump_path)
-    
+    extract(tar_path, dump_path, selective)
     print("Done")
+
+def main():
+    args = [arg for arg in sys.argv[1:] if arg not in ("--selective", "--index")]
+    if len(args) != 2:
+        print("Usage: python3 tar_extraction.py <tar_path> <dump_path> [--selective] [--index]")
+        sys.exit(1)
+
+    try:
+        run(
+            args[0],
+            args[1],
+            selective=SELECTIVE_EXTRACTION or "--selective" in sys.argv,
+            index=INDEX_EXTRACTION or "--index" in sys.argv
+        )
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()